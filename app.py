@@ -1,15 +1,17 @@
 import os
 import gc
+import hashlib
 import json
+import re
+import string
+import tempfile
 import threading
 import time
+import uuid
+from collections import OrderedDict, deque
+from itertools import islice
+from html.parser import HTMLParser
 from flask import Flask, request, jsonify, render_template, stream_with_context, Response, session, redirect, url_for
-import google.generativeai as genai
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
 import io
 from dotenv import load_dotenv
 
@@ -27,12 +29,39 @@ app.secret_key = os.environ.get('SECRET_KEY', 'redactor_dev_secret_key_static_fa
 
 # Initialize Gemini
 api_key = os.environ.get("api_key")
-if not api_key:
+
+# Extra keys (comma separated) to spread batch traffic over several quotas.
+# The first key is the primary one, used by genai.configure (model listing).
+API_KEYS = list(dict.fromkeys(
+    k.strip() for k in [api_key or ''] + os.environ.get('api_keys', '').split(',') if k.strip()
+))
+PRIMARY_API_KEY = API_KEYS[0] if API_KEYS else None
+if not PRIMARY_API_KEY:
     print("WARNING: 'api_key' environment variable not found. Please set it or create a .env file.")
 
-if api_key:
-    genai.configure(api_key=api_key)
+# The Gemini SDK and the Google API clients are heavy to import, so they are loaded on
+# first use instead of at import time to keep Render cold starts and worker boots fast.
+_genai = None
+_genai_lock = threading.Lock()
+
+def get_genai():
+    """Import and configure the Gemini SDK on first use."""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                import google.generativeai as genai
+                if PRIMARY_API_KEY:
+                    genai.configure(api_key=PRIMARY_API_KEY)
+                _genai = genai
+    return _genai
+
+def log_available_models():
+    """Print the models that support generateContent (diagnostics only, makes a network call)."""
+    if not PRIMARY_API_KEY:
+        return
     try:
+        genai = get_genai()
         print("Available models:")
         for m in genai.list_models():
             if 'generateContent' in m.supported_generation_methods:
@@ -40,6 +69,16 @@ if api_key:
     except Exception as e:
         print(f"Error listing models: {e}")
 
+_models_listing_started = False
+
+@app.before_request
+def start_model_listing():
+    """List models in the background on the first request, whatever server runs the app."""
+    global _models_listing_started
+    if not _models_listing_started:
+        _models_listing_started = True
+        threading.Thread(target=log_available_models, daemon=True).start()
+
 # Try models in order of preference until one works
 AVAILABLE_MODELS = [
     "models/gemini-3.0-pro",        # 3.0 Pro Para produccion - PRIMERA PREFERENCIA
@@ -49,77 +88,446 @@ AVAILABLE_MODELS = [
     "models/gemini-2.0-pro-exp",    # Pro Experimental
 ]
 
-def get_working_model():
-    """Find the first working model from the available list."""
-    import time
-    for model_name in AVAILABLE_MODELS:
-        try:
-            model = genai.GenerativeModel(model_name)
-            # Test with a simple prompt
-            test_response = model.generate_content("Hi", generation_config=genai.types.GenerationConfig(max_output_tokens=10))
-            print(f"✓ Using model: {model_name}")
-            return model_name
-        except Exception as e:
-            error_str = str(e)
+# Model preference per phase. Flash is enough for the outline and the critique;
+# the draft and the final version keep AVAILABLE_MODELS order (pro first).
+FAST_MODELS = [m for m in AVAILABLE_MODELS if 'flash' in m]
+PHASE_MODELS = {
+    'phase_1': FAST_MODELS + [m for m in AVAILABLE_MODELS if m not in FAST_MODELS],
+    'phase_2': AVAILABLE_MODELS,
+    'phase_3': FAST_MODELS + [m for m in AVAILABLE_MODELS if m not in FAST_MODELS],
+    'phase_4': AVAILABLE_MODELS,
+}
+
+# Client-side quota tracking per key
+GEMINI_KEY_RPM = int(os.environ.get('GEMINI_KEY_RPM', 0))  # Requests per minute per key, 0 = unlimited
+RATE_LIMIT_COOLDOWN = 60   # Seconds a key/model pair is skipped after a 429
+ROUTER_MAX_WAIT = 120      # Seconds to wait for a free key before giving up
+GEMINI_CALL_ATTEMPTS = 4   # Calls rerouted after a 429/404 before failing
+
+class GeminiRouter:
+    """
+    Spreads Gemini calls over the configured API keys and healthy models.
+
+    Each key tracks its in-flight calls and the requests made in the last minute. A
+    key/model pair that gets a 429 cools down for RATE_LIMIT_COOLDOWN seconds, and a model
+    the API reports as not found is skipped for every key. A call goes to the first healthy
+    model of its preference list, on the least-loaded key; if every pair is busy it waits
+    for one to free up instead of failing straight away.
+    """
+
+    def __init__(self, keys, rpm_limit=0):
+        self.keys = list(keys)
+        self.rpm_limit = rpm_limit
+        self._cond = threading.Condition()
+        self._in_flight = {key: 0 for key in self.keys}
+        self._recent = {key: deque() for key in self.keys}
+        self._cooldown_until = {}
+        self._missing_models = set()
+
+    def _load(self, key, now):
+        """(in-flight calls, requests in the last 60s) for a key."""
+        recent = self._recent[key]
+        while recent and recent[0] <= now - 60:
+            recent.popleft()
+        return self._in_flight[key], len(recent)
+
+    def _pick(self, models, keys, now):
+        for model_name in models:
+            if model_name in self._missing_models:
+                continue
+            candidates = []
+            for key in keys:
+                if self._cooldown_until.get((key, model_name), 0) > now:
+                    continue
+                load = self._load(key, now)
+                if self.rpm_limit and load[1] >= self.rpm_limit:
+                    continue
+                candidates.append((load, key))
+            if candidates:
+                return min(candidates, key=lambda c: c[0])[1], model_name
+        return None
+
+    def _next_free_at(self, keys, now):
+        """Earliest time a cooldown or quota window expires."""
+        times = [until for (key, _), until in self._cooldown_until.items() if key in keys]
+        if self.rpm_limit:
+            times += [self._recent[key][0] + 60 for key in keys if self._recent[key]]
+        times = [t for t in times if t > now]
+        return min(times) if times else None
+
+    def acquire(self, models, key=None):
+        """
+        Reserve a key for a call. Call release(key) when the call is over.
+
+        Args:
+            models (list[str]): Candidate models in order of preference.
+            key (str, optional): Use only this key (e.g. the key that owns a context cache).
+
+        Returns:
+            tuple: (api key, model name)
+        """
+        keys = [key] if key else self.keys
+        if not keys:
+            raise Exception("No Gemini API key configured. Set 'api_key' (and optionally 'api_keys').")
+
+        deadline = time.time() + ROUTER_MAX_WAIT
+        with self._cond:
+            while True:
+                now = time.time()
+                lane = self._pick(models, keys, now)
+                if lane:
+                    self._in_flight[lane[0]] += 1
+                    self._recent[lane[0]].append(now)
+                    return lane
+                if all(m in self._missing_models for m in models):
+                    raise Exception("No working Gemini models found. Please check your API key.")
+                free_at = self._next_free_at(keys, now)
+                if free_at is None or free_at > deadline:
+                    raise Exception("All Gemini keys are rate limited. Please wait for rate limits to reset.")
+                self._cond.wait(free_at - now)
+
+    def release(self, key):
+        with self._cond:
+            self._in_flight[key] -= 1
+            self._cond.notify_all()
+
+    def report_error(self, key, model_name, error):
+        """
+        Record a failed call.
+
+        Returns:
+            bool: True if another key/model may succeed (429 or unknown model).
+        """
+        error_str = str(error)
+        with self._cond:
             if "429" in error_str or "quota" in error_str.lower():
-                print(f"⚠ Model {model_name} rate limited, trying next...")
-            elif "404" in error_str:
-                print(f"✗ Model {model_name} not found")
-            else:
-                print(f"✗ Model {model_name} error: {e}")
-            continue
-    raise Exception("No working Gemini models found. Please check your API key or wait for rate limits to reset.")
-
-# Determine working model at startup (MOVED TO LAZY LOAD)
-WORKING_MODEL = None
-# We no longer check strictly at startup to avoid "Time Out" during Render deploy
-# if api_key:
-#     try:
-#         WORKING_MODEL = get_working_model()
-#     except Exception as e:
-#         print(f"ERROR: {e}")
-
-def generate_completion(prompt, model_name=None, max_tokens=None, stream=False):
-    """Helper function to call Google Gemini API."""
-    global WORKING_MODEL
-    
-    if model_name is None:
-        if not WORKING_MODEL:
+                print(f"⚠ Model {model_name} rate limited on key #{self.keys.index(key) + 1}, rerouting...")
+                self._cooldown_until[(key, model_name)] = time.time() + RATE_LIMIT_COOLDOWN
+                return True
+            # Only when the error names the model: a 404 for e.g. an expired cache says nothing about it
+            if "404" in error_str and f"{model_name} is not found" in error_str:
+                print(f"✗ Model {model_name} not found, skipping it")
+                self._missing_models.add(model_name)
+                return True
+        return False
+
+    def pick_model(self, models):
+        """Preferred healthy model, without reserving a key (e.g. to size a context cache)."""
+        with self._cond:
+            lane = self._pick(models, self.keys, time.time())
+            if lane:
+                return lane[1]
+            healthy = [m for m in models if m not in self._missing_models]
+            if not healthy:
+                raise Exception("No working Gemini models found. Please check your API key.")
+            return healthy[0]
+
+ROUTER = GeminiRouter(API_KEYS, rpm_limit=GEMINI_KEY_RPM)
+
+_key_clients = {}
+
+def get_key_client(key, service='generative'):
+    """
+    Gemini API client bound to one key, created once per key.
+
+    genai.configure only holds one key, so calls are made with the API clients directly.
+
+    Args:
+        key (str): API key.
+        service (str): 'generative' (generateContent) or 'cache' (cachedContents).
+    """
+    if (key, service) not in _key_clients:
+        get_genai()
+        from google.ai import generativelanguage as glm
+        client_class = glm.CacheServiceClient if service == 'cache' else glm.GenerativeServiceClient
+        _key_clients[(key, service)] = client_class(client_options={"api_key": key})
+    return _key_clients[(key, service)]
+
+def release_after_stream(stream, key):
+    """Keep the key reserved until a streamed response has been fully read."""
+    try:
+        for chunk in stream:
+            yield chunk
+    finally:
+        ROUTER.release(key)
+
+# Characters of the Phase 2 draft kept for Phases 3 and 4 (caps per-article memory and tokens)
+DRAFT_MAX_CHARS = 8000
+
+# Prompt templates live in prompts/<set>/<name>.txt and are compiled once at startup.
+# A set only needs the files it changes; the rest are taken from the default set.
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompts')
+DEFAULT_PROMPT_SET = os.environ.get('PROMPT_SET', 'default')
+PROMPT_NAMES = ('system', 'phase_1', 'phase_2', 'article_context', 'phase_3', 'phase_4')
+# Values generate_article_logic passes to each template; a template may use any of them
+PROMPT_FIELDS = {
+    'system': frozenset(),
+    'phase_1': frozenset(['topic', 'title']),
+    'phase_2': frozenset(['plan']),
+    'article_context': frozenset(['truncated_draft']),
+    'phase_3': frozenset(),
+    'phase_4': frozenset(['critique']),
+}
+
+class PromptTemplate:
+    """A prompt template parsed once, so rendering only joins the pieces."""
+
+    def __init__(self, name, text):
+        self.name = name
+        self.text = text
+        self.version = hashlib.sha256(text.encode('utf-8')).hexdigest()[:12]
+        self._segments = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(text):
+            if field is not None and (not field.isidentifier() or format_spec or conversion):
+                raise ValueError(f"Prompt '{name}': only plain {{name}} placeholders are supported, got {{{field}}}")
+            self._segments.append((literal, field))
+        self.fields = frozenset(field for _, field in self._segments if field)
+
+    def render(self, **values):
+        parts = []
+        for literal, field in self._segments:
+            parts.append(literal)
+            if field is not None:
+                parts.append(str(values[field]))
+        return ''.join(parts)
+
+class PromptSet:
+    """The templates used for one article, tagged with a version hash of their contents."""
+
+    def __init__(self, name, templates):
+        self.name = name
+        self.templates = templates
+        combined = '|'.join(f"{n}:{templates[n].version}" for n in PROMPT_NAMES)
+        # Usable as cache key and metric label: changes whenever any template changes
+        self.version = hashlib.sha256(combined.encode('utf-8')).hexdigest()[:12]
+        self.system_instruction = templates['system'].render()
+
+    def render(self, name, **values):
+        return self.templates[name].render(**values)
+
+def load_prompt_sets(prompts_dir=PROMPTS_DIR, default_set=DEFAULT_PROMPT_SET):
+    """
+    Read and compile every prompt set under prompts_dir.
+
+    Placeholders are checked against PROMPT_FIELDS and default_set must exist, so a broken
+    prompt fails at startup instead of on every article.
+    """
+    def read_set(set_name):
+        templates = {}
+        set_dir = os.path.join(prompts_dir, set_name)
+        for name in PROMPT_NAMES:
+            path = os.path.join(set_dir, f"{name}.txt")
+            if os.path.exists(path):
+                with open(path, 'r', encoding='utf-8') as f:
+                    template = PromptTemplate(name, f.read().rstrip('\n'))
+                unknown = template.fields - PROMPT_FIELDS[name]
+                if unknown:
+                    expected = ', '.join(f"{{{f}}}" for f in sorted(PROMPT_FIELDS[name])) or 'none'
+                    raise ValueError(f"Prompt {set_name}/{name}.txt uses unknown placeholders "
+                                     f"{', '.join(f'{{{f}}}' for f in sorted(unknown))} (available: {expected})")
+                templates[name] = template
+        return templates
+
+    defaults = read_set('default')
+    missing = [name for name in PROMPT_NAMES if name not in defaults]
+    if missing:
+        raise Exception(f"Default prompt set is missing: {', '.join(missing)}")
+
+    prompt_sets = {}
+    for set_name in sorted(os.listdir(prompts_dir)):
+        if os.path.isdir(os.path.join(prompts_dir, set_name)):
+            templates = dict(defaults)
+            templates.update(read_set(set_name))
+            prompt_sets[set_name] = PromptSet(set_name, templates)
+    if default_set not in prompt_sets:
+        raise ValueError(f"PROMPT_SET '{default_set}' not found in {prompts_dir}. Available: {', '.join(prompt_sets)}")
+    return prompt_sets
+
+PROMPT_SETS = load_prompt_sets()
+
+def get_prompt_set(name=None):
+    """Return the prompt set called name (DEFAULT_PROMPT_SET if empty)."""
+    name = name or DEFAULT_PROMPT_SET
+    if name not in PROMPT_SETS:
+        raise ValueError(f"Unknown prompt set '{name}'. Available: {', '.join(PROMPT_SETS)}")
+    return PROMPT_SETS[name]
+
+# Explicit context caching of the article text shared by Phases 3 and 4
+CONTEXT_CACHE_ENABLED = os.environ.get('CONTEXT_CACHE_ENABLED', '1') == '1'
+CONTEXT_CACHE_TTL = int(os.environ.get('CONTEXT_CACHE_TTL', 600))  # Seconds
+# Gemini rejects caches below a per-model minimum token count, so short texts aren't even tried.
+# Checked by model family (first match wins); anything unknown uses the default.
+CONTEXT_CACHE_MIN_TOKENS = [('flash', 1024), ('pro', 4096)]
+CONTEXT_CACHE_DEFAULT_MIN_TOKENS = 4096
+CHARS_PER_TOKEN = 4  # Rough estimate, errs on the side of not uploading
+# Minimums reported by the API in "too small" errors, they override the table above
+CONTEXT_CACHE_LEARNED_MIN_TOKENS = {}
+CACHE_MIN_TOKENS_RE = re.compile(r'minimum token count[^0-9]*(\d+)', re.IGNORECASE)
+# Models that definitely don't support caching, so we don't retry on every article
+CONTEXT_CACHE_UNSUPPORTED = set()
+
+def context_cache_min_tokens(model_name):
+    """Smallest number of tokens Gemini accepts in a cache for model_name."""
+    if model_name in CONTEXT_CACHE_LEARNED_MIN_TOKENS:
+        return CONTEXT_CACHE_LEARNED_MIN_TOKENS[model_name]
+    for family, min_tokens in CONTEXT_CACHE_MIN_TOKENS:
+        if family in model_name:
+            return min_tokens
+    return CONTEXT_CACHE_DEFAULT_MIN_TOKENS
+
+def is_cache_expired_error(error):
+    """True when a call referenced a cachedContents entry that no longer exists."""
+    error_str = str(error)
+    return ('404' in error_str or '403' in error_str) and 'cachedcontent' in error_str.lower().replace(' ', '')
+
+def is_cache_unsupported_error(error):
+    """True only when the API says the model can't create caches at all."""
+    error_str = str(error)
+    return 'createCachedContent' in error_str and ('not supported' in error_str or 'not found' in error_str)
+
+class LocalContextCache:
+    """
+    Local stand-in for Gemini context caching.
+
+    Keeps the shared contents in memory and resends them with every prompt. Used when
+    caching is disabled, the text is too short or the model doesn't support it.
+    """
+
+    # Not uploaded: any key and model can serve the calls
+    name = None
+    api_key = None
+
+    def __init__(self, model_name, contents, system_instruction):
+        self.model_name = model_name
+        self.contents = list(contents)
+        self.system_instruction = system_instruction
+
+    def build_contents(self, prompt):
+        return "\n\n".join(self.contents + [prompt])
+
+    def delete(self):
+        self.contents = []
+
+class GeminiContextCache(LocalContextCache):
+    """
+    Gemini explicit context cache: contents are uploaded once and referenced by later calls.
+
+    A cache belongs to the model and key that created it, so every call using it runs there.
+    Once it expires, calls resend the contents like LocalContextCache.
+    """
+
+    def __init__(self, name, model_name, contents, system_instruction, api_key):
+        super().__init__(model_name, contents, system_instruction)
+        self.name = name
+        self.api_key = api_key
+
+    def expire(self):
+        """The cache is gone on the server; later calls resend the contents."""
+        self.name = None
+
+    def delete(self):
+        if self.name:
             try:
-                print("Lazy loading: Checking for working model...")
-                WORKING_MODEL = get_working_model()
+                get_key_client(self.api_key, 'cache').delete_cached_content(name=self.name)
             except Exception as e:
-                print(f"Error initializing model: {e}")
-                
-        model_name = WORKING_MODEL
-    
-    if not model_name:
-        raise Exception("No working Gemini model available")
-    
-    model = genai.GenerativeModel(model_name)
+                print(f"Error deleting context cache: {e}")
+        super().delete()
+
+def upload_context_cache(model_name, contents, prompt_set, key):
+    """Create the Gemini cache for contents with key. Raises whatever the API raises."""
+    protos = get_genai().protos
+    cached_content = get_key_client(key, 'cache').create_cached_content(cached_content=protos.CachedContent(
+        model=model_name,
+        display_name=f"redactor-{prompt_set.name}-{prompt_set.version}",
+        system_instruction=protos.Content(parts=[protos.Part(text=prompt_set.system_instruction)]),
+        contents=[protos.Content(role='user', parts=[protos.Part(text=c)]) for c in contents],
+        ttl={'seconds': CONTEXT_CACHE_TTL}
+    ))
+    return GeminiContextCache(cached_content.name, model_name, contents, prompt_set.system_instruction, key)
+
+def create_context_cache(contents, model_name=None, prompt_set=None):
+    """
+    Upload contents shared by several prompts together with the system instruction.
+
+    Args:
+        contents (list[str]): Texts every later prompt refers to.
+        model_name (str, optional): Model to cache for. Defaults to the preferred healthy model
+            for the final phase. The cache is created on the least-loaded key for that model, and
+            once uploaded every phase using it runs there.
+        prompt_set (PromptSet, optional): Supplies the system instruction. Defaults to get_prompt_set().
+
+    Returns:
+        GeminiContextCache or LocalContextCache: pass it as cached_context to generate_completion.
+    """
+    model_name = model_name or ROUTER.pick_model(PHASE_MODELS['phase_4'])
+    prompt_set = prompt_set or get_prompt_set()
+
+    estimated_tokens = sum(len(c) for c in contents + [prompt_set.system_instruction]) // CHARS_PER_TOKEN
+    if (not CONTEXT_CACHE_ENABLED or model_name in CONTEXT_CACHE_UNSUPPORTED
+            or estimated_tokens < context_cache_min_tokens(model_name)):
+        return LocalContextCache(model_name, contents, prompt_set.system_instruction)
+
+    key = None
+    try:
+        key, _ = ROUTER.acquire([model_name])
+        return upload_context_cache(model_name, contents, prompt_set, key)
+    except Exception as e:
+        # Only a definite "unsupported" answer disables caching for the model. Too-small texts
+        # teach us the real minimum; anything else (429, 5xx...) just skips caching this time.
+        if is_cache_unsupported_error(e):
+            CONTEXT_CACHE_UNSUPPORTED.add(model_name)
+        else:
+            match = CACHE_MIN_TOKENS_RE.search(str(e))
+            if match:
+                CONTEXT_CACHE_LEARNED_MIN_TOKENS[model_name] = int(match.group(1))
+        print(f"Context caching not available for {model_name}, resending contents instead: {e}")
+        return LocalContextCache(model_name, contents, prompt_set.system_instruction)
+    finally:
+        if key:
+            ROUTER.release(key)
+
+def generate_completion(prompt, model_name=None, max_tokens=None, stream=False, cached_context=None, system_instruction=None,
+                        phase=None):
+    """
+    Helper function to call Google Gemini API.
+
+    Calls go through ROUTER: the model is model_name, or the first healthy model for phase
+    (PHASE_MODELS, AVAILABLE_MODELS if no phase), on the least-loaded API key. Calls that hit
+    a 429 or an unknown model are rerouted to another key/model.
+
+    If cached_context (from create_context_cache) is given, the prompt is sent on top of
+    its contents with its system instruction, and model_name and system_instruction are
+    ignored. An uploaded cache pins every call (whatever the phase) to its model and key,
+    so all the phases sharing it reference it. A local one (or an uploaded cache that has
+    expired) resends the contents and routes by phase, on the cache's model if no phase.
+    system_instruction defaults to the default prompt set's.
+    """
+    genai = get_genai()
+    protos = genai.protos
+    pinned_key = None
+    use_cache = False
+    if cached_context is not None:
+        system_instruction = cached_context.system_instruction
+        use_cache = cached_context.name is not None
+        if use_cache:
+            models = [cached_context.model_name]
+            pinned_key = cached_context.api_key
+            contents = prompt
+        else:
+            models = PHASE_MODELS[phase] if phase else [cached_context.model_name]
+            contents = cached_context.build_contents(prompt)
+    else:
+        models = [model_name] if model_name else PHASE_MODELS.get(phase, AVAILABLE_MODELS)
+        if system_instruction is None:
+            system_instruction = get_prompt_set().system_instruction
+        contents = prompt
     
     # Configure generation config
-    generation_config = genai.types.GenerationConfig(
+    generation_config = protos.GenerationConfig(
         max_output_tokens=max_tokens,
         temperature=0.7
     )
 
-    # System instruction prepended to prompt
-    system_instruction = "Eres un redactor profesional especializado en SEO y copywriting. Escribe contenido claro, estructurado y optimizado para buscadores en español.\n\n"
-
-    ''' Para produccion: Este prompt configura la "personalidad" de la IA. Usamos mayúsculas para directrices inquebrantables.
-# ROLE
-You are an Elite SEO Content Strategist and Senior Copywriter specialized in the Spanish market. Your writing style is authoritative, engaging, and indistinguishable from a human expert.
-
-# CORE DIRECTIVES
-1. **E-E-A-T PRINCIPLE**: Demonstrate Experience, Expertise, Authoritativeness, and Trustworthiness in every output.
-2. **LANGUAGE**: All content generated must be in **Native European Spanish** (unless specified otherwise).
-3. **USER-CENTRIC**: Prioritize the user's search intent over keyword stuffing. The content must solve problems.
-4. **FORMAT**: You are a master of HTML structure. Your code is clean, semantic, and accessible.
-    '''
-    
-    full_prompt = system_instruction + prompt
-
     # Configure safety settings to avoid blocking content
     safety_settings = [
         {
@@ -140,15 +548,46 @@ You are an Elite SEO Content Strategist and Senior Copywriter specialized in the
         },
     ]
 
-    response = model.generate_content(
-        full_prompt,
-        generation_config=generation_config,
-        safety_settings=safety_settings,
-        stream=stream
-    )
-    
-    if stream:
-        return response
+    for attempt in range(1, GEMINI_CALL_ATTEMPTS + 1):
+        key, lane_model = ROUTER.acquire(models, key=pinned_key)
+        try:
+            request = protos.GenerateContentRequest(
+                model=lane_model,
+                contents=[protos.Content(role='user', parts=[protos.Part(text=contents)])],
+                generation_config=generation_config,
+                safety_settings=[protos.SafetySetting(**setting) for setting in safety_settings]
+            )
+            if use_cache:
+                # The system instruction is part of the cache
+                request.cached_content = cached_context.name
+            elif system_instruction:
+                request.system_instruction = protos.Content(parts=[protos.Part(text=system_instruction)])
+
+            client = get_key_client(key)
+            if stream:
+                # from_iterator already waits for the first chunk, so 429s surface here too
+                response = genai.types.GenerateContentResponse.from_iterator(client.stream_generate_content(request))
+            else:
+                response = genai.types.GenerateContentResponse.from_response(client.generate_content(request))
+        except Exception as e:
+            ROUTER.release(key)
+            if use_cache and is_cache_expired_error(e) and attempt < GEMINI_CALL_ATTEMPTS:
+                # The cache outlived its TTL (or was deleted): resend the contents instead
+                print(f"Context cache {cached_context.name} is gone, resending contents: {e}")
+                cached_context.expire()
+                use_cache = False
+                models = PHASE_MODELS[phase] if phase else [cached_context.model_name]
+                pinned_key = None
+                contents = cached_context.build_contents(prompt)
+                continue
+            if attempt == GEMINI_CALL_ATTEMPTS or not ROUTER.report_error(key, lane_model, e):
+                raise
+            continue
+
+        if stream:
+            return release_after_stream(response, key)
+        ROUTER.release(key)
+        break
     
     # Check if response was blocked or incomplete
     if not response.candidates:
@@ -223,6 +662,10 @@ def get_drive_service(creds_dict=None):
         if not creds_dict:
             raise Exception("Not authenticated. Please authorize first by visiting /authorize")
     
+    from google.oauth2.credentials import Credentials
+    from google.auth.transport.requests import Request
+    from googleapiclient.discovery import build
+
     # Load credentials
     creds = Credentials(**creds_dict)
     
@@ -283,6 +726,69 @@ def find_or_create_folder(service, folder_name='redactor'):
         folder = service.files().create(body=file_metadata, fields='id').execute()
         return folder.get('id')
 
+# Markdown fences the model sometimes wraps the final HTML in (```html ... ```)
+CODE_FENCE = '```'
+FENCE_LANGUAGE_RE = re.compile(r'\s*html\s*', re.IGNORECASE)
+# Text after a fence that could still grow into "html" once more chunks arrive
+FENCE_LANGUAGE_PREFIX_RE = re.compile(r'\s*(?:h(?:t(?:ml?)?)?)?', re.IGNORECASE)
+
+# Tags that never have a closing tag, ignored when checking balance
+VOID_ELEMENTS = frozenset([
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+    'link', 'meta', 'source', 'track', 'wbr',
+])
+
+class ArticleHTMLScanner(HTMLParser):
+    """Incremental HTML scanner that captures the first H1 and tracks tag balance."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.h1_parts = None
+        self.in_h1 = False
+        self.open_tags = []
+        self.unbalanced_tags = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in VOID_ELEMENTS:
+            return
+        if tag == 'h1' and self.h1_parts is None:
+            self.in_h1 = True
+            self.h1_parts = []
+        self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in VOID_ELEMENTS:
+            return
+        if tag == 'h1':
+            self.in_h1 = False
+        if tag not in self.open_tags:
+            # Closing tag without a matching opening tag
+            self.unbalanced_tags.append(f"</{tag}>")
+            return
+        # Anything opened after the matching tag was left unclosed
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            if open_tag == tag:
+                break
+            self.unbalanced_tags.append(f"<{open_tag}>")
+
+    def handle_data(self, data):
+        if self.in_h1:
+            self.h1_parts.append(data)
+
+    @property
+    def h1(self):
+        """Text of the first H1 (nested tags removed) or None if not found."""
+        if self.h1_parts is None:
+            return None
+        return ''.join(self.h1_parts).strip() or None
+
+    def close(self):
+        super().close()
+        # Tags still open at the end of the document
+        self.unbalanced_tags.extend(f"<{tag}>" for tag in reversed(self.open_tags))
+        self.open_tags = []
+
 def extract_h1_from_html(html_content):
     """
     Extract the text content of the first H1 tag from HTML.
@@ -293,35 +799,174 @@ def extract_h1_from_html(html_content):
     Returns:
         str: H1 text content or None if not found
     """
-    import re
-    # Try to find H1 tag (case insensitive)
-    h1_match = re.search(r'<h1[^>]*>(.*?)</h1>', html_content, re.IGNORECASE | re.DOTALL)
-    if h1_match:
-        # Get the content and remove any HTML tags inside
-        h1_text = h1_match.group(1)
-        # Remove any nested HTML tags
-        h1_text = re.sub(r'<[^>]+>', '', h1_text)
-        # Clean up whitespace
-        h1_text = h1_text.strip()
-        return h1_text
-    return None
-
-def save_article_to_drive(title, content, service=None, folder_name='redactor'):
+    scanner = ArticleHTMLScanner()
+    scanner.feed(html_content)
+    scanner.close()
+    return scanner.h1
+
+class StreamingArticleSanitizer:
+    """
+    Cleans the Phase 4 stream chunk by chunk.
+
+    Removes markdown code fences and the surrounding whitespace as chunks arrive,
+    holding back only the few characters that could still be part of a fence.
+    The cleaned text is fed to an ArticleHTMLScanner, so the final article, its H1
+    and the tag balance report are ready the moment the last chunk lands.
+    """
+
+    def __init__(self):
+        self._pending = ''
+        self._trailing_ws = ''
+        self._started = False
+        self._parts = []
+        self._scanner = ArticleHTMLScanner()
+
+    def feed(self, chunk):
+        """Add a raw chunk and return the cleaned text that can be sent to the client now."""
+        self._pending += chunk
+        return self._drain(final=False)
+
+    def close(self):
+        """Flush whatever is still held back and return the last cleaned text."""
+        text = self._drain(final=True)
+        self._scanner.close()
+        return text
+
+    @property
+    def article(self):
+        return ''.join(self._parts)
+
+    @property
+    def title(self):
+        return self._scanner.h1
+
+    @property
+    def unbalanced_tags(self):
+        return self._scanner.unbalanced_tags
+
+    def _drain(self, final):
+        buf = self._pending
+        out = []
+        fence_pending = False
+        while True:
+            idx = buf.find(CODE_FENCE)
+            if idx == -1:
+                break
+            out.append(buf[:idx])
+            rest = buf[idx + len(CODE_FENCE):]
+            match = FENCE_LANGUAGE_RE.match(rest)
+            # Wait for more text if the language tag (or the whitespace after it) may continue
+            if not final and ((match and match.end() == len(rest))
+                              or (not match and FENCE_LANGUAGE_PREFIX_RE.fullmatch(rest))):
+                buf = buf[idx:]
+                fence_pending = True
+                break
+            buf = rest[match.end():] if match else rest
+
+        if not fence_pending:
+            # Trailing backticks may be the start of a fence split across chunks
+            keep = 0 if final else len(buf) - len(buf.rstrip('`'))
+            out.append(buf[:len(buf) - keep])
+            buf = buf[len(buf) - keep:]
+        self._pending = buf
+
+        text = self._trailing_ws + ''.join(out)
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        stripped = text.rstrip()
+        # Whitespace is only emitted once more content follows it
+        self._trailing_ws = '' if final else text[len(stripped):]
+        text = stripped
+
+        if text:
+            self._parts.append(text)
+            self._scanner.feed(text)
+        return text
+
+# Drive upload resilience
+DRIVE_UPLOAD_ATTEMPTS = int(os.environ.get('DRIVE_UPLOAD_ATTEMPTS', 4))
+DRIVE_UPLOAD_RETRIES = 3  # Retries googleapiclient does itself per chunk (5xx, 429, connection errors)
+DRIVE_UPLOAD_CHUNK_SIZE = 1024 * 1024  # Must be a multiple of 256 KB; only the failed chunk is resent
+# appProperties key holding the idempotency key of an uploaded article
+IDEMPOTENCY_PROPERTY = 'redactorKey'
+
+def article_idempotency_key(topic, title, prompt_set=None):
+    """
+    Stable key for an article request, so resubmitting the same row finds the existing document.
+    The prompt set version is part of the key: after editing the prompts the article is generated again.
+    """
+    prompts = get_prompt_set(prompt_set)
+    raw = json.dumps([topic, title or '', prompts.name, prompts.version], ensure_ascii=False)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()[:32]
+
+def idempotency_property_value(idempotency_key):
+    """
+    Value stored in appProperties for an idempotency key.
+
+    Keys can come from the client, so they are hashed: the value is always 64 hex characters,
+    safe to put in a Drive query and within the 124-byte limit of a property.
+    """
+    return hashlib.sha256(str(idempotency_key).encode('utf-8')).hexdigest()
+
+def find_article_by_key(service, idempotency_key):
+    """
+    Look for a document previously uploaded with idempotency_key.
+
+    Returns:
+        dict: File metadata (id, webViewLink) or None if not found
+    """
+    value = idempotency_property_value(idempotency_key)
+    query = f"appProperties has {{ key='{IDEMPOTENCY_PROPERTY}' and value='{value}' }} and trashed=false"
+    results = service.files().list(q=query, spaces='drive', fields='files(id, webViewLink)', pageSize=1).execute()
+    files = results.get('files', [])
+    return files[0] if files else None
+
+def is_retryable_drive_error(error):
+    """Server errors, rate limits and network failures are worth retrying; auth and bad requests are not."""
+    from googleapiclient.errors import HttpError
+
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        return status >= 500 or status in (404, 410, 429) or (status == 403 and 'rateLimitExceeded' in str(error))
+    return isinstance(error, (OSError, TimeoutError))
+
+def save_article_to_drive(title, content, service=None, folder_name='redactor', idempotency_key=None):
     """
     Saves an article content to Google Drive.
 
+    The upload is resumable: failed chunks are retried and an interrupted session is resumed
+    where it stopped, or restarted if Drive dropped it. With an idempotency_key the document is
+    tagged in appProperties, and an existing document with the same key is returned instead of
+    uploading a duplicate.
+
     Args:
         title (str): Title of the article
         content (str): HTML content of the article
         service: Google Drive service instance (optional, creates one if None)
         folder_name (str): Target folder name
+        idempotency_key (str, optional): Key identifying this article (see article_idempotency_key)
 
     Returns:
         dict: File metadata (id, link)
     """
+    from googleapiclient.errors import HttpError
+    from googleapiclient.http import MediaIoBaseUpload
+
     if not service:
         service = get_drive_service()
 
+    if idempotency_key:
+        # A failed lookup shouldn't stop the upload, at worst it duplicates the document
+        try:
+            existing = find_article_by_key(service, idempotency_key)
+        except Exception as e:
+            print(f"Could not check for an existing document: {e}")
+            existing = None
+        if existing:
+            print(f"Article already in Drive (key {idempotency_key}), skipping upload")
+            return existing
+
     # Find or create folder
     folder_id = find_or_create_folder(service, folder_name)
 
@@ -331,91 +976,112 @@ def save_article_to_drive(title, content, service=None, folder_name='redactor'):
         'mimeType': 'application/vnd.google-apps.document',  # Convert to Google Doc
         'parents': [folder_id]
     }
+    if idempotency_key:
+        file_metadata['appProperties'] = {IDEMPOTENCY_PROPERTY: idempotency_property_value(idempotency_key)}
+
+    full_html = f"<html><body>{content}</body></html>".encode('utf-8')
 
-    # Create media
-    full_html = f"<html><body>{content}</body></html>"
-    media = MediaIoBaseUpload(io.BytesIO(full_html.encode('utf-8')),
-                                mimetype='text/html',
-                                resumable=True)
+    def start_upload():
+        media = MediaIoBaseUpload(io.BytesIO(full_html),
+                                    mimetype='text/html',
+                                    chunksize=DRIVE_UPLOAD_CHUNK_SIZE,
+                                    resumable=True)
+        return service.files().create(body=file_metadata,
+                                        media_body=media,
+                                        fields='id, webViewLink')
 
     # Upload file
-    file = service.files().create(body=file_metadata,
-                                    media_body=media,
-                                    fields='id, webViewLink').execute()
-    return file
+    upload = start_upload()
+    for attempt in range(1, DRIVE_UPLOAD_ATTEMPTS + 1):
+        try:
+            file = None
+            while file is None:
+                status, file = upload.next_chunk(num_retries=DRIVE_UPLOAD_RETRIES)
+            return file
+        except Exception as e:
+            if attempt == DRIVE_UPLOAD_ATTEMPTS or not is_retryable_drive_error(e):
+                raise
+            print(f"Drive upload failed (attempt {attempt}/{DRIVE_UPLOAD_ATTEMPTS}): {e}. Retrying...")
+            time.sleep(2 ** attempt)
 
-def generate_article_logic(topic, title, yield_json=True):
+            # The upload may have completed even though the response was lost
+            if idempotency_key:
+                try:
+                    existing = find_article_by_key(service, idempotency_key)
+                    if existing:
+                        return existing
+                except Exception as lookup_error:
+                    print(f"Could not check for an existing document: {lookup_error}")
+
+            # The same request asks Drive how much it received (or whether the upload already
+            # finished) and resumes from there, after HTTP and network errors alike. Only an
+            # expired session (404/410) or one that was never opened is restarted from scratch.
+            if upload.resumable_uri is None or (isinstance(e, HttpError) and e.resp.status in (404, 410)):
+                upload = start_upload()
+
+def format_event(event, yield_json):
+    """Encode a progress event as a JSON line for the web client, or keep it as a dict for internal callers."""
+    return json.dumps(event) + "\n" if yield_json else event
+
+def generate_article_logic(topic, title, yield_json=True, prompt_set=None):
     """
     Core generation logic.
     
     Args:
         topic (str): Topic to write about.
         title (str): Suggested title.
-        yield_json (bool): If True, yields JSON strings for SSE. If False, yields plain updates and finally the HTML.
+        yield_json (bool): If True, yields JSON strings for SSE. If False, yields plain update dicts
+            (phase transitions and errors, no stream chunks) and finally a 'complete' dict with the
+            HTML ('final_article') and its H1 ('title', None if not found).
+        prompt_set (str, optional): Name of the prompt set to use. Defaults to DEFAULT_PROMPT_SET.
         
     Yields:
-        str: JSON strings or internal status/content.
+        str | dict: JSON strings or internal status/content.
     """
+    article_context = None
     try:
+        prompts = get_prompt_set(prompt_set)
+        system_instruction = prompts.system_instruction
+
         # Phase 1: Planificación
-        if yield_json: yield json.dumps({"status": "phase_1", "message": "Generando esquema SEO..."}) + "\n"
+        yield format_event({"status": "phase_1", "message": "Generando esquema SEO..."}, yield_json)
         
-        prompt_phase_1 = f"""Generate a detailed and SEO-optimized outline for an article about: **{topic}**
-Suggested title: **{title}**
-
-Your output must include:
+        prompt_phase_1 = prompts.render('phase_1', topic=topic, title=title)
 
-- **Search intent** of the user.
-- **Primary and secondary keywords**.
-- A highly specific **H1 / H2 / H3 structure**.
-- **Key points** to be covered in every section.
-- **Concrete examples** that enhance clarity and depth.
-
-Do *not* write the article.
-Produce only the complete outline."""
-
-        plan, truncated_phase_1 = generate_completion(prompt_phase_1, max_tokens=800)
+        plan, truncated_phase_1 = generate_completion(prompt_phase_1, max_tokens=800, system_instruction=system_instruction, phase='phase_1')
         if not plan:
-            if yield_json: yield json.dumps({"error": "Error en Fase 1: No se pudo generar el plan"}) + "\n"
+            yield format_event({"error": "Error en Fase 1: No se pudo generar el plan"}, yield_json)
             return
 
-        if yield_json:
-            status = "phase_1_truncated" if truncated_phase_1 else "phase_1_done"
-            yield json.dumps({"status": status, "data": plan}) + "\n"
+        status = "phase_1_truncated" if truncated_phase_1 else "phase_1_done"
+        yield format_event({"status": status, "data": plan}, yield_json)
         del prompt_phase_1
         gc.collect()
 
         # Phase 2: Redacción
-        if yield_json: yield json.dumps({"status": "phase_2", "message": "Redactando borrador..."}) + "\n"
+        yield format_event({"status": "phase_2", "message": "Redactando borrador..."}, yield_json)
         
-        prompt_phase_2 = f"""Write the full article **exclusively following this outline**:
-
-{plan}
-
-Requirements:
-
-- Do not add new sections.
-- Maintain clarity, precision, and zero filler content.
-- Include verifiable or neutral data when relevant.
-- Apply **moderate** keyword density.
-- Avoid repeating ideas using synonyms.
-- Output the article in clean **HTML format** using semantic tags (h1, h2, h3, p, ul, li…), but **do not include** `<html>` or `<body>` tags.
-- At the end of the article, include a **final closing paragraph**, but do **not** label it as a conclusion and do **not** use the words "conclusion", "summary", "resumen", or any synonym. It must simply function as the natural final paragraph of the article.
-
-Write the full article now."""
+        prompt_phase_2 = prompts.render('phase_2', plan=plan)
+        # The plan is only needed to build the Phase 2 prompt
+        del plan
 
         # Stream Phase 2 content
-        stream = generate_completion(prompt_phase_2, max_tokens=1500, stream=True)
+        stream = generate_completion(prompt_phase_2, max_tokens=1500, stream=True, system_instruction=system_instruction,
+                                     phase='phase_2')
         if not stream:
-            if yield_json: yield json.dumps({"error": "Error en Fase 2: No se pudo iniciar la redacción"}) + "\n"
+            yield format_event({"error": "Error en Fase 2: No se pudo iniciar la redacción"}, yield_json)
             return
 
-        draft = ""
+        # Only the first DRAFT_MAX_CHARS are used by Phases 3 and 4, the rest is streamed but not kept
+        draft_parts = []
+        draft_length = 0
         truncated_phase_2 = False
         for chunk in stream:
             if hasattr(chunk, 'text') and chunk.text:
                 content_chunk = chunk.text
-                draft += content_chunk
+                if draft_length < DRAFT_MAX_CHARS:
+                    draft_parts.append(content_chunk[:DRAFT_MAX_CHARS - draft_length])
+                draft_length += len(content_chunk)
                 if yield_json: yield json.dumps({"status": "phase_2_stream", "chunk": content_chunk}) + "\n"
             # Check for truncation
             if hasattr(chunk, 'candidates') and chunk.candidates:
@@ -423,118 +1089,93 @@ Write the full article now."""
                 if finish_reason == 2:  # MAX_TOKENS
                     truncated_phase_2 = True
 
-        if not draft:
-            if yield_json: yield json.dumps({"error": "Error en Fase 2: Borrador vacío"}) + "\n"
+        if not draft_length:
+            yield format_event({"error": "Error en Fase 2: Borrador vacío"}, yield_json)
             return
 
-        if yield_json:
-            status = "phase_2_truncated" if truncated_phase_2 else "phase_2_done"
-            yield json.dumps({"status": status, "data": "Borrador completado"}) + "\n"
+        status = "phase_2_truncated" if truncated_phase_2 else "phase_2_done"
+        yield format_event({"status": status, "data": "Borrador completado"}, yield_json)
         del prompt_phase_2, stream
         gc.collect()
 
         # Phase 3: Revisión
-        if yield_json: yield json.dumps({"status": "phase_3", "message": "Revisando contenido..."}) + "\n"
-
-        # Truncate to avoid excessive tokens and memory usage
-        truncated_draft = draft[:8000]
-        # Free memory if draft is very large
-        if len(draft) > 8000:
-            del draft
-            gc.collect() 
-        
-        prompt_phase_3 = f"""Evaluate and critique the following article with the goal of boosting SEO performance:
-
-{truncated_draft}
-
-Identify and list:
+        yield format_event({"status": "phase_3", "message": "Revisando contenido..."}, yield_json)
 
-- Redundant or repetitive phrases
-- Weak, vague, or unsupported statements
-- Unnecessary repetitions of ideas
-- Opportunities to increase clarity or precision
-- Cases of keyword over-optimization
+        # Truncated to avoid excessive tokens and memory usage
+        truncated_draft = ''.join(draft_parts)
+        del draft_parts
 
-Provide **specific, actionable corrections** without rewriting the entire article."""
+        # Upload the draft once; Phases 3 and 4 both run on the cache's model and reference it
+        article_context = create_context_cache([prompts.render('article_context', truncated_draft=truncated_draft)],
+                                               prompt_set=prompts)
+        del truncated_draft
+        
+        prompt_phase_3 = prompts.render('phase_3')
 
-        critique, truncated_phase_3 = generate_completion(prompt_phase_3, max_tokens=600)
+        critique, truncated_phase_3 = generate_completion(prompt_phase_3, max_tokens=600, cached_context=article_context,
+                                                          phase='phase_3')
         if not critique:
-            if yield_json: yield json.dumps({"error": "Error en Fase 3: No se pudo generar la crítica"}) + "\n"
+            yield format_event({"error": "Error en Fase 3: No se pudo generar la crítica"}, yield_json)
             return
 
-        if yield_json:
-            status = "phase_3_truncated" if truncated_phase_3 else "phase_3_done"
-            yield json.dumps({"status": status, "data": critique}) + "\n"
+        status = "phase_3_truncated" if truncated_phase_3 else "phase_3_done"
+        yield format_event({"status": status, "data": critique}, yield_json)
         del prompt_phase_3
         gc.collect()
 
         # Phase 4: Finalización
-        if yield_json: yield json.dumps({"status": "phase_4", "message": "Aplicando mejoras finales..."}) + "\n"
+        yield format_event({"status": "phase_4", "message": "Aplicando mejoras finales..."}, yield_json)
         
-        prompt_phase_4 = f"""Using the following article and its critique:
-
-**Original Article:**
-{truncated_draft}
-
-**Review:**
-{critique}
-
-Produce the **final, polished version** of the article.
-
-Apply all suggested corrections and enhancements.
-
-Return **only the HTML article code**, with no Markdown, no explanations, and no `<html>` or `<body>` tags.
-Do not include images.
-
-Generate the article *in Spanish* (from Spain)."""
+        prompt_phase_4 = prompts.render('phase_4', critique=critique)
+        del critique
 
         # Stream Phase 4 content
-        stream_final = generate_completion(prompt_phase_4, max_tokens=2000, stream=True)
+        stream_final = generate_completion(prompt_phase_4, max_tokens=2000, stream=True, cached_context=article_context,
+                                           phase='phase_4')
         if not stream_final:
-            if yield_json: yield json.dumps({"error": "Error en Fase 4: No se pudo iniciar la versión final"}) + "\n"
+            yield format_event({"error": "Error en Fase 4: No se pudo iniciar la versión final"}, yield_json)
             return
 
-        final_article = ""
+        # Sanitize while streaming so the client only ever receives clean HTML
+        sanitizer = StreamingArticleSanitizer()
         truncated_phase_4 = False
         for chunk in stream_final:
             if hasattr(chunk, 'text') and chunk.text:
-                content_chunk = chunk.text
-                final_article += content_chunk
-                if yield_json: yield json.dumps({"status": "phase_4_stream", "chunk": content_chunk}) + "\n"
+                content_chunk = sanitizer.feed(chunk.text)
+                if yield_json and content_chunk: yield json.dumps({"status": "phase_4_stream", "chunk": content_chunk}) + "\n"
             # Check for truncation
             if hasattr(chunk, 'candidates') and chunk.candidates:
                 finish_reason = chunk.candidates[0].finish_reason
                 if finish_reason == 2:  # MAX_TOKENS
                     truncated_phase_4 = True
 
+        content_chunk = sanitizer.close()
+        if yield_json and content_chunk: yield json.dumps({"status": "phase_4_stream", "chunk": content_chunk}) + "\n"
+
+        # The draft is no longer needed once Phase 4 is done
+        del prompt_phase_4, stream_final
+        article_context.delete()
+        article_context = None
+
+        final_article = sanitizer.article
+        article_title = sanitizer.title
         if not final_article:
-             if yield_json: yield json.dumps({"error": "Error en Fase 4: El artículo final se generó vacío."}) + "\n"
+             yield format_event({"error": "Error en Fase 4: El artículo final se generó vacío."}, yield_json)
              return
 
-        # Cleanup - Remove markdown code blocks and extra whitespace
-        import re
-        # Remove markdown code block markers (case insensitive, with or without spaces)
-        final_article = re.sub(r'```\s*html\s*', '', final_article, flags=re.IGNORECASE)
-        final_article = re.sub(r'```', '', final_article)
-        # Remove leading/trailing whitespace
-        final_article = final_article.strip()
+        if sanitizer.unbalanced_tags:
+            print(f"WARNING: Final article has unbalanced tags: {', '.join(sanitizer.unbalanced_tags)}")
 
         # Send phase 4 completion status before the final article
-        if yield_json:
-            status = "phase_4_truncated" if truncated_phase_4 else "phase_4_done"
-            yield json.dumps({"status": status, "data": "Artículo finalizado"}) + "\n"
+        status = "phase_4_truncated" if truncated_phase_4 else "phase_4_done"
+        yield format_event({"status": status, "data": "Artículo finalizado"}, yield_json)
 
         # Cleanup: delete large objects and run garbage collection
-        del prompt_phase_4, critique, stream_final, plan, truncated_draft
-        # Only delete draft if it wasn't already deleted
-        if 'draft' in locals():
-            del draft
+        del sanitizer
         gc.collect()
 
-        if yield_json:
-            yield json.dumps({"status": "complete", "final_article": final_article}) + "\n"
-        else:
-            yield final_article
+        yield format_event({"status": "complete", "final_article": final_article, "title": article_title,
+                            "prompt_set": prompts.name, "prompt_version": prompts.version}, yield_json)
 
     except Exception as e:
         print(f"Generate Exception: {e}")
@@ -543,79 +1184,282 @@ Generate the article *in Spanish* (from Spain)."""
             yield json.dumps({"error": error_msg}) + "\n"
         else:
             raise e
+    finally:
+        # Drop the cached draft as soon as the article is done (or abandoned)
+        if article_context is not None:
+            article_context.delete()
 
-def process_batch(rows, credentials_dict=None):
+# Batch progress events, kept in memory with a bounded footprint
+BATCH_EVENTS_MAX = int(os.environ.get('BATCH_EVENTS_MAX', 500))      # Events kept per batch
+BATCH_HISTORY_MAX = int(os.environ.get('BATCH_HISTORY_MAX', 50))     # Batches kept once finished
+BATCH_EVENTS_HEARTBEAT = 15  # Seconds between keep-alive messages on idle streams
+
+class BatchEventLog:
     """
-    Process a batch of articles in the background.
-    Iterates through rows, generates content, and uploads to Drive.
+    Progress events of a single batch stored in a fixed-size ring buffer.
+
+    Every event gets an increasing sequence number so clients can resume with
+    ?after=<seq> (or Last-Event-ID). When the buffer is full the oldest events
+    are dropped and reported to late readers as missed.
     """
-    print(f"Starting batch processing of {len(rows)} items...")
 
-    # Authenticate service once if possible, or per request if needed.
-    # Since this runs in a thread, we can't access 'session' directly easily if it expires.
-    # We pass the credentials dictionary explicitly, or let get_drive_service load from file.
-    try:
-        service = get_drive_service(creds_dict=credentials_dict)
-    except Exception as e:
-        print(f"Batch Error: Could not authenticate Drive: {str(e)}")
-        # Try one more time forcing file load if creds_dict was None
-        if not credentials_dict:
-             try:
-                 print("Attempting to load credentials from file for batch...")
-                 service = get_drive_service() # Will try file
-             except Exception as e2:
-                 print(f"Batch Error (Fallback): {str(e2)}")
-                 return
-        else:
-             return
+    def __init__(self, batch_id, total, maxlen=BATCH_EVENTS_MAX):
+        self.batch_id = batch_id
+        self.total = total
+        self.started_at = time.time()
+        self.finished = False
+        self._events = deque(maxlen=maxlen)
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def emit(self, status, **fields):
+        """Record an event and wake up any stream waiting for it."""
+        with self._cond:
+            self._seq += 1
+            event = {"seq": self._seq, "t": round(time.time() - self.started_at, 2), "status": status}
+            event.update(fields)
+            self._events.append(event)
+            self._cond.notify_all()
+        return event
+
+    def finish(self):
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+
+    def wait_for_events(self, after, timeout):
+        """
+        Return the events newer than 'after', waiting up to 'timeout' seconds for one.
+
+        Returns:
+            tuple: (events, number of events already dropped from the buffer, finished flag)
+        """
+        with self._cond:
+            if self._seq <= after and not self.finished:
+                self._cond.wait(timeout)
+            first_seq = self._seq - len(self._events) + 1
+            start = max(after + 1, first_seq) - first_seq
+            events = list(islice(self._events, start, None))
+            missed = max(0, first_seq - after - 1)
+            return events, missed, self.finished
+
+BATCHES = OrderedDict()
+BATCHES_LOCK = threading.Lock()
+
+def register_batch(total):
+    """Create the event log for a new batch, forgetting the oldest finished batches."""
+    log = BatchEventLog(uuid.uuid4().hex, total)
+    with BATCHES_LOCK:
+        BATCHES[log.batch_id] = log
+        excess = len(BATCHES) - BATCH_HISTORY_MAX
+        if excess > 0:
+            for batch_id in [bid for bid, b in BATCHES.items() if b.finished][:excess]:
+                del BATCHES[batch_id]
+    return log
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson')
+# Fields of a batch row we actually use; anything else sent by Sheets is dropped on ingestion
+BATCH_ROW_FIELDS = ('palabra_clave', 'titulo_sugerido', 'plantilla', 'idempotency_key', 'regenerar')
+# Values of 'regenerar' that force a new article (Sheets sends checkboxes as TRUE/FALSE)
+TRUE_VALUES = ('1', 'true', 'si', 'sí', 'yes', 'x')
+
+class BatchRowStore:
+    """
+    Batch rows spooled to a temporary NDJSON file instead of kept in a list.
+
+    Rows are written as they are parsed and read back one at a time while the batch
+    runs, so memory doesn't grow with the number of rows. The file is removed on close().
+    """
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile(mode='w+', encoding='utf-8')
+        self._count = 0
+
+    def add(self, row):
+        if not isinstance(row, dict):
+            raise ValueError("Each row must be a JSON object")
+        row = {key: row.get(key) for key in BATCH_ROW_FIELDS if row.get(key) is not None}
+        self._file.write(json.dumps(row, ensure_ascii=False) + "\n")
+        self._count += 1
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        self._file.flush()
+        self._file.seek(0)
+        for line in self._file:
+            yield json.loads(line)
+
+    def close(self):
+        self._file.close()
 
-    for i, row in enumerate(rows):
-        topic = row.get('palabra_clave')
-        suggested_title = row.get('titulo_sugerido', '')
+NDJSON_READ_SIZE = 64 * 1024  # Bytes read from the request body at a time
 
-        if not topic:
+def iter_stream_lines(stream, block_size=NDJSON_READ_SIZE):
+    """
+    Lines of a binary stream, read in blocks.
+
+    request.stream is unbuffered, so iterating it directly reads the body one byte per call.
+    """
+    pending = b''
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        lines = (pending + block).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
+
+def read_ndjson_rows(stream, store):
+    """
+    Parse an NDJSON request body line by line into store.
+
+    Raises:
+        ValueError: If a line is not a JSON object.
+    """
+    for line_number, line in enumerate(iter_stream_lines(stream), 1):
+        line = line.strip()
+        if not line:
             continue
+        try:
+            row = json.loads(line)
+        except ValueError as e:
+            raise ValueError(f"Line {line_number}: invalid JSON ({e})")
+        if not isinstance(row, dict):
+            raise ValueError(f"Line {line_number}: each line must be a JSON object")
+        store.add(row)
+
+def process_batch(rows, credentials_dict=None, events=None):
+    """
+    Process a batch of articles in the background.
+    Iterates through rows, generates content, and uploads to Drive.
+    Progress is recorded in 'events' (a BatchEventLog) for /batches/<id>/events.
+    A BatchRowStore passed as rows is closed when the batch ends.
+    """
+    if events is None:
+        events = BatchEventLog(None, len(rows))
 
-        print(f"[{i+1}/{len(rows)}] Processing: {topic}")
+    print(f"Starting batch processing of {len(rows)} items...")
+    events.emit("batch_started", total=len(rows))
 
+    try:
+        # Authenticate service once if possible, or per request if needed.
+        # Since this runs in a thread, we can't access 'session' directly easily if it expires.
+        # We pass the credentials dictionary explicitly, or let get_drive_service load from file.
         try:
-            # Generate Article
-            # Iterate through the generator until the end to get the final result
-            final_content = None
-            generator = generate_article_logic(topic, suggested_title, yield_json=False)
-
-            for result in generator:
-                # The last yielded value from generate_article_logic(yield_json=False) is the final HTML
-                final_content = result
-
-            if final_content:
-                # Extract title from H1 tag in the generated HTML
-                doc_title = extract_h1_from_html(final_content)
-
-                # Fallback to suggested title or topic if no H1 found
-                if not doc_title:
-                    doc_title = suggested_title if suggested_title else f"Articulo: {topic}"
-                    print(f"Warning: No H1 found in generated article. Using fallback title: {doc_title}")
-
-                # Upload to Drive
-                print(f"Uploading '{doc_title}' to Drive...")
-                file_info = save_article_to_drive(doc_title, final_content, service=service)
-                print(f"✓ Uploaded: {doc_title}")
-                print(f"  Drive link: {file_info.get('webViewLink', 'N/A')}")
+            service = get_drive_service(creds_dict=credentials_dict)
+        except Exception as e:
+            print(f"Batch Error: Could not authenticate Drive: {str(e)}")
+            # Try one more time forcing file load if creds_dict was None
+            if not credentials_dict:
+                 try:
+                     print("Attempting to load credentials from file for batch...")
+                     service = get_drive_service() # Will try file
+                 except Exception as e2:
+                     print(f"Batch Error (Fallback): {str(e2)}")
+                     events.emit("batch_error", error=str(e2))
+                     return
             else:
-                print(f"✗ Failed to generate content for {topic}")
+                 events.emit("batch_error", error=str(e))
+                 return
 
-        except Exception as e:
-            print(f"✗ Error processing {topic}: {e}")
-            import traceback
-            traceback.print_exc()
+        uploaded = 0
+        for i, row in enumerate(rows):
+            topic = row.get('palabra_clave')
+            suggested_title = row.get('titulo_sugerido', '')
+            # Optional prompt set name, lets a sheet A/B test prompt versions per row
+            prompt_set = row.get('plantilla')
 
-        # Heavy cleanup after each item
-        gc.collect()
-        # Small pause to be nice to APIs
-        time.sleep(2)
+            if not topic:
+                events.emit("row_skipped", row=i)
+                continue
 
-    print(f"Batch processing complete. Processed {len(rows)} item(s).")
+            print(f"[{i+1}/{len(rows)}] Processing: {topic}")
+            events.emit("row_started", row=i, topic=topic, prompt_set=prompt_set or DEFAULT_PROMPT_SET)
+            row_start = time.time()
+
+            try:
+                # Same row submitted again (retried or resumed batch) -> same key.
+                # Fails for an unknown prompt set, which is reported as this row's error.
+                idempotency_key = row.get('idempotency_key') or article_idempotency_key(topic, suggested_title, prompt_set)
+                if str(row.get('regenerar', '')).strip().lower() in TRUE_VALUES:
+                    # New document even if this article is already in Drive; the key stays fixed
+                    # for this run so its own upload retries don't duplicate it
+                    idempotency_key = f"{idempotency_key}:{uuid.uuid4().hex}"
+
+                # Skip generation entirely if a previous run already uploaded this article
+                try:
+                    existing = find_article_by_key(service, idempotency_key)
+                except Exception as e:
+                    print(f"Could not check for an existing document: {e}")
+                    existing = None
+                if existing:
+                    print(f"✓ Already in Drive: {existing.get('webViewLink', 'N/A')}")
+                    events.emit("row_done", row=i, link=existing.get('webViewLink'), existing=True,
+                                duration=round(time.time() - row_start, 2))
+                    continue
+
+                # Generate Article
+                # Iterate through the generator until the end to get the final result
+                final_result = None
+                error = None
+                generator = generate_article_logic(topic, suggested_title, yield_json=False, prompt_set=prompt_set)
+
+                for result in generator:
+                    if 'error' in result:
+                        error = result['error']
+                    elif result['status'] == 'complete':
+                        final_result = result
+                    else:
+                        # Phase transition (phase_N, phase_N_done, phase_N_truncated)
+                        events.emit(result['status'], row=i)
+
+                if final_result:
+                    final_content = final_result['final_article']
+                    # H1 already captured while Phase 4 was streaming
+                    doc_title = final_result['title']
+
+                    # Fallback to suggested title or topic if no H1 found
+                    if not doc_title:
+                        doc_title = suggested_title if suggested_title else f"Articulo: {topic}"
+                        print(f"Warning: No H1 found in generated article. Using fallback title: {doc_title}")
+
+                    # Upload to Drive
+                    print(f"Uploading '{doc_title}' to Drive...")
+                    events.emit("uploading", row=i)
+                    file_info = save_article_to_drive(doc_title, final_content, service=service,
+                                                      idempotency_key=idempotency_key)
+                    uploaded += 1
+                    print(f"✓ Uploaded: {doc_title}")
+                    print(f"  Drive link: {file_info.get('webViewLink', 'N/A')}")
+                    events.emit("row_done", row=i, title=doc_title, link=file_info.get('webViewLink'),
+                                prompt_version=final_result['prompt_version'],
+                                duration=round(time.time() - row_start, 2))
+                else:
+                    print(f"✗ Failed to generate content for {topic}")
+                    events.emit("row_error", row=i, error=error or "No se pudo generar el artículo",
+                                duration=round(time.time() - row_start, 2))
+
+            except Exception as e:
+                print(f"✗ Error processing {topic}: {e}")
+                import traceback
+                traceback.print_exc()
+                events.emit("row_error", row=i, error=str(e), duration=round(time.time() - row_start, 2))
+
+            # Heavy cleanup after each item
+            gc.collect()
+            # Small pause to be nice to APIs
+            time.sleep(2)
+
+        print(f"Batch processing complete. Processed {len(rows)} item(s).")
+        events.emit("batch_complete", total=len(rows), uploaded=uploaded)
+    finally:
+        if isinstance(rows, BatchRowStore):
+            rows.close()
+        events.finish()
 
 @app.route('/authorize')
 def authorize():
@@ -630,6 +1474,8 @@ def authorize():
         else:
             redirect_uri = url_for('oauth2callback', _external=True, _scheme='https')
         
+        from google_auth_oauthlib.flow import Flow
+
         # Create flow instance
         flow = Flow.from_client_config(
             oauth_config,
@@ -670,6 +1516,8 @@ def oauth2callback():
         else:
             redirect_uri = url_for('oauth2callback', _external=True, _scheme='https')
         
+        from google_auth_oauthlib.flow import Flow
+
         # Create flow instance
         flow = Flow.from_client_config(
             oauth_config,
@@ -702,6 +1550,10 @@ def auth_status():
         else:
             return jsonify({"authenticated": False})
 
+        from google.oauth2.credentials import Credentials
+        from google.auth.transport.requests import Request
+        from googleapiclient.discovery import build
+
         # Check if credentials are valid
         creds = Credentials(**creds_dict)
 
@@ -756,22 +1608,35 @@ def index():
     
     if request.method == 'POST':
         # Handle data from Google Sheets or external sources
-        if request.is_json:
+        # Large batches can be sent as NDJSON (one row per line), parsed incrementally
+        is_ndjson = request.mimetype in NDJSON_MIMETYPES
+        if request.is_json or is_ndjson:
+            rows = BatchRowStore()
+            thread = None
             try:
-                data = request.json
-                
-                # CHECK FOR BATCH INPUT ("filas")
-                if 'filas' in data and isinstance(data['filas'], list):
-                    rows = data['filas']
-                # Handle single item inputs (Sheets single row or direct JSON)
-                # Sheets sends 'palabra_clave' and 'titulo_sugerido'
-                elif 'palabra_clave' in data:
-                    rows = [{
-                        'palabra_clave': data.get('palabra_clave'),
-                        'titulo_sugerido': data.get('titulo_sugerido', '')
-                    }]
-                else: 
-                     return jsonify({"status": "error", "message": "JSON must contain 'filas' list or 'palabra_clave'"}), 400
+                if is_ndjson:
+                    read_ndjson_rows(request.stream, rows)
+                else:
+                    data = request.json
+
+                    # CHECK FOR BATCH INPUT ("filas")
+                    if 'filas' in data and isinstance(data['filas'], list):
+                        for row in data['filas']:
+                            rows.add(row)
+                    # Handle single item inputs (Sheets single row or direct JSON)
+                    # Sheets sends 'palabra_clave' and 'titulo_sugerido'
+                    elif 'palabra_clave' in data:
+                        rows.add({
+                            'palabra_clave': data.get('palabra_clave'),
+                            'titulo_sugerido': data.get('titulo_sugerido', ''),
+                            'plantilla': data.get('plantilla'),
+                            'regenerar': data.get('regenerar')
+                        })
+                    else: 
+                         rows.close()
+                         return jsonify({"status": "error", "message": "JSON must contain 'filas' list or 'palabra_clave'"}), 400
+                    # Rows now live in the store, don't keep the parsed body around
+                    del data
 
                 # Process whatever rows we have (1 or many)
 
@@ -779,18 +1644,27 @@ def index():
                 creds_dict = session.get('credentials')
 
                 if not creds_dict:
+                    rows.close()
                     return jsonify({"status": "error", "message": "No estás autenticado en Google Drive. Por favor visita la web y conecta Drive primero."}), 401
                 
-                # Start background thread
-                thread = threading.Thread(target=process_batch, args=(rows, creds_dict))
+                # Start background thread (process_batch closes the row store when done)
+                events = register_batch(len(rows))
+                thread = threading.Thread(target=process_batch, args=(rows, creds_dict, events))
                 thread.daemon = True # Daemon thread so it doesn't block app shutdown
                 thread.start()
                 
                 return jsonify({
                     "status": "processing_started",
-                    "message": f"Se ha iniciado el procesamiento de {len(rows)} artículo(s) en segundo plano."
+                    "message": f"Se ha iniciado el procesamiento de {len(rows)} artículo(s) en segundo plano.",
+                    "batch_id": events.batch_id,
+                    "events_url": url_for('batch_events', batch_id=events.batch_id)
                 })
+            except ValueError as e:
+                rows.close()
+                return jsonify({"status": "error", "message": str(e)}), 400
             except Exception as e:
+                if thread is None:
+                    rows.close()
                 return jsonify({"status": "error", "message": str(e)}), 500
         return jsonify({"status": "error", "message": "JSON required"}), 400
     if os.path.exists(DRAFT_FILE):
@@ -810,6 +1684,8 @@ def upload_to_drive():
         data = request.json
         content = data.get('content')
         title = data.get('title', 'Articulo Generado')
+        # Optional, lets the client retry without creating a second document
+        idempotency_key = data.get('idempotency_key')
         
         if not content:
             return jsonify({"error": "No content provided"}), 400
@@ -817,7 +1693,7 @@ def upload_to_drive():
         # Use helper function
         # Get authenticated Drive service with current session
         service = get_drive_service()
-        file = save_article_to_drive(title, content, service=service)
+        file = save_article_to_drive(title, content, service=service, idempotency_key=idempotency_key)
                                       
         return jsonify({
             "success": True, 
@@ -849,24 +1725,69 @@ def debug_drive():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/batches/<batch_id>/events')
+def batch_events(batch_id):
+    """
+    Stream the progress events of a batch started with POST /.
+
+    Sends Server-Sent Events when the client asks for text/event-stream, NDJSON otherwise.
+    Resume with ?after=<seq> or the Last-Event-ID header. The stream ends once the batch
+    has finished and every buffered event has been sent.
+    """
+    with BATCHES_LOCK:
+        events = BATCHES.get(batch_id)
+    if events is None:
+        return jsonify({"error": "Batch not found"}), 404
+
+    try:
+        after = int(request.args.get('after', request.headers.get('Last-Event-ID', 0)))
+    except ValueError:
+        return jsonify({"error": "'after' must be an integer"}), 400
+
+    use_sse = request.accept_mimetypes.best == 'text/event-stream'
+
+    def encode(event):
+        if use_sse:
+            return f"id: {event['seq']}\ndata: {json.dumps(event)}\n\n" if 'seq' in event else f"data: {json.dumps(event)}\n\n"
+        return json.dumps(event) + "\n"
+
+    def event_stream():
+        last_seq = after
+        while True:
+            batch_events, missed, finished = events.wait_for_events(last_seq, BATCH_EVENTS_HEARTBEAT)
+            if missed:
+                yield encode({"status": "events_dropped", "missed": missed})
+            for event in batch_events:
+                yield encode(event)
+                last_seq = event['seq']
+            if finished and not batch_events:
+                break
+            if not batch_events and not missed:
+                # Keep proxies from closing an idle connection
+                yield ": keep-alive\n\n" if use_sse else encode({"status": "heartbeat"})
+
+    mimetype = 'text/event-stream' if use_sse else 'application/x-ndjson'
+    return Response(event_stream(), mimetype=mimetype, headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/generate', methods=['POST'])
 def generate_article():
     gc.collect()
     data = request.json
     topic = data.get('topic')
     title = data.get('title')
+    prompt_set = data.get('prompt_set')
 
     if not topic:
         return jsonify({"error": "Se requiere un tema (topic)."}), 400
 
     def generate_stream():
          # Re-use logic in JSON yielding mode
-         for msg in generate_article_logic(topic, title, yield_json=True):
+         for msg in generate_article_logic(topic, title, yield_json=True, prompt_set=prompt_set):
              yield msg
 
     return Response(stream_with_context(generate_stream()), mimetype='application/json')
 
 if __name__ == '__main__':
-    from waitress import serve
-    port = int(os.environ.get('PORT', 5000))
-    serve(app, host='0.0.0.0', port=port)
+    # Serving profile (waitress, gthread, gevent, asgi) is picked with SERVER_PROFILE
+    from serve import run
+    run(app)
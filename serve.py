@@ -0,0 +1,112 @@
+"""
+Production server for Redactor.
+
+/generate keeps its connection open for the whole four-phase generation (often one
+or two minutes), so the server has to be sized by concurrent streams, not requests
+per second. The profile is chosen with SERVER_PROFILE:
+
+- waitress: single process, SERVER_THREADS threads (one per open stream). Default.
+- gthread:  gunicorn with WEB_CONCURRENCY processes x SERVER_THREADS threads.
+- gevent:   gunicorn with gevent workers, SERVER_CONNECTIONS greenlets per worker
+            (needs `pip install gevent`).
+- asgi:     gunicorn with uvicorn workers running the app through a2wsgi's
+            WSGIMiddleware on a pool of SERVER_THREADS threads per worker
+            (needs `pip install uvicorn a2wsgi`).
+
+Usage:
+    SERVER_PROFILE=gthread python serve.py
+"""
+import os
+
+PROFILES = ('waitress', 'gthread', 'gevent', 'asgi')
+
+PORT = int(os.environ.get('PORT', 5000))
+# One thread is held by each open /generate stream
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 32))
+# Batch progress (/batches/<id>/events) lives in process memory, so more than one
+# worker only works behind a proxy that pins a batch's requests to its worker
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+SERVER_CONNECTIONS = int(os.environ.get('SERVER_CONNECTIONS', 500))
+# Longest generation we are willing to wait for before a worker is considered stuck
+STREAM_TIMEOUT = int(os.environ.get('STREAM_TIMEOUT', 300))
+
+def gunicorn_options(profile):
+    """Gunicorn settings for a profile."""
+    options = {
+        'bind': f"0.0.0.0:{PORT}",
+        'workers': WEB_CONCURRENCY,
+        'timeout': STREAM_TIMEOUT,
+        'graceful_timeout': STREAM_TIMEOUT,
+        'keepalive': 75,
+        # Workers load the app themselves so gevent can patch before anything is imported
+        'preload_app': False,
+    }
+    if profile == 'gthread':
+        options.update({'worker_class': 'gthread', 'threads': SERVER_THREADS})
+    elif profile == 'gevent':
+        options.update({'worker_class': 'gevent', 'worker_connections': SERVER_CONNECTIONS,
+                        'post_worker_init': _init_grpc_gevent})
+    elif profile == 'asgi':
+        options.update({'worker_class': 'uvicorn.workers.UvicornWorker'})
+    return options
+
+def _init_grpc_gevent(worker):
+    """The Gemini SDK talks gRPC, which needs its gevent integration under gevent workers."""
+    try:
+        import grpc.experimental.gevent as grpc_gevent
+        grpc_gevent.init_gevent()
+    except ImportError:
+        pass
+
+def load_app(profile):
+    """Import the Flask app, wrapped for ASGI when needed."""
+    from app import app
+    if profile == 'asgi':
+        # The WSGI app still needs one thread per open stream. asgiref's WsgiToAsgi would
+        # run every request of a worker on a single shared thread.
+        from a2wsgi import WSGIMiddleware
+        return WSGIMiddleware(app, workers=SERVER_THREADS)
+    return app
+
+def run_gunicorn(profile):
+    from gunicorn.app.base import BaseApplication
+
+    class RedactorApplication(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return load_app(profile)
+
+    RedactorApplication(gunicorn_options(profile)).run()
+
+def run_waitress(app=None):
+    from waitress import serve
+    serve(app or load_app('waitress'), host='0.0.0.0', port=PORT,
+          threads=SERVER_THREADS, channel_timeout=STREAM_TIMEOUT)
+
+def run(app=None, profile=None):
+    """
+    Start the server with the given profile (SERVER_PROFILE by default).
+
+    Args:
+        app: Already imported Flask app, only used by the waitress profile.
+        profile (str, optional): One of PROFILES.
+    """
+    profile = profile or os.environ.get('SERVER_PROFILE', 'waitress')
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown SERVER_PROFILE '{profile}'. Use one of: {', '.join(PROFILES)}")
+
+    print(f"Starting server on port {PORT} with profile '{profile}'")
+    if profile == 'waitress':
+        run_waitress(app)
+    else:
+        run_gunicorn(profile)
+
+if __name__ == '__main__':
+    run()
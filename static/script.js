@@ -16,6 +16,9 @@ document.addEventListener('DOMContentLoaded', () => {
     const debugDraft = document.getElementById('debugDraft');
     const debugCritique = document.getElementById('debugCritique');
 
+    // Identifies the current article so retried uploads don't create duplicate Docs
+    let articleKey = null;
+
     // Check authentication status on page load
     async function checkAuthStatus() {
         try {
@@ -204,6 +207,7 @@ document.addEventListener('DOMContentLoaded', () => {
                         } else if (data.status === 'complete') {
                             // Ensure final clean version is set
                             articleContent.innerHTML = data.final_article;
+                            articleKey = window.crypto && crypto.randomUUID ? crypto.randomUUID() : null;
                             btnText.textContent = '¡Completado!';
                             // Don't modify step4 here - it's already been set by phase_4_done or phase_4_truncated
                             resultsSection.style.display = 'block';
@@ -269,7 +273,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ content, title })
+                body: JSON.stringify({ content, title, idempotency_key: articleKey })
             });
 
             const result = await response.json();
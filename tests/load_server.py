@@ -0,0 +1,49 @@
+"""
+Starts serve.py with a fake Gemini backend for the load tests.
+
+Every model call sleeps instead of hitting the API, so a /generate stream stays open for
+a known time (ARTICLE_SECONDS) and the number of streams a profile keeps open at once can
+be measured without quota.
+
+Usage: PORT=... SERVER_THREADS=... python tests/load_server.py <profile>
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import serve
+
+CALL_SECONDS = 0.25   # Each of the four phases
+STREAM_CHUNKS = 5
+ARTICLE_SECONDS = 4 * CALL_SECONDS
+
+class FakeChunk:
+    candidates = []
+
+    def __init__(self, text):
+        self.text = text
+
+def fake_generate_completion(prompt, model_name=None, max_tokens=None, stream=False, **kwargs):
+    if stream:
+        def chunks():
+            for i in range(STREAM_CHUNKS):
+                time.sleep(CALL_SECONDS / STREAM_CHUNKS)
+                yield FakeChunk("<h1>Fake</h1>" if i == 0 else f"<p>{i}</p>")
+        return chunks()
+    time.sleep(CALL_SECONDS)
+    return "fake output", False
+
+real_load_app = serve.load_app
+
+def load_fake_app(profile):
+    # Runs inside the worker, after gevent has patched time.sleep
+    import app
+    app.generate_completion = fake_generate_completion
+    app.create_context_cache = lambda contents, **kwargs: app.LocalContextCache('fake', contents, '')
+    return real_load_app(profile)
+
+if __name__ == '__main__':
+    serve.load_app = load_fake_app
+    serve.run(profile=sys.argv[1])
@@ -0,0 +1,91 @@
+import json
+from collections import OrderedDict
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    monkeypatch.setattr(app, 'BATCHES', OrderedDict())
+    return app.BATCHES
+
+
+@pytest.fixture
+def client():
+    return app.app.test_client()
+
+
+def finished_batch(batches, count, maxlen=app.BATCH_EVENTS_MAX):
+    log = app.BatchEventLog(f"batch{len(batches)}", count, maxlen=maxlen)
+    batches[log.batch_id] = log
+    for i in range(count):
+        log.emit("row_done", row=i)
+    log.finish()
+    return log
+
+
+def ndjson(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_wrapped_buffer_reports_dropped_events():
+    log = app.BatchEventLog(None, 10, maxlen=3)
+    for i in range(10):
+        log.emit("row_done", row=i)
+    events, missed, finished = log.wait_for_events(0, 0)
+    assert [e['seq'] for e in events] == [8, 9, 10]
+    assert missed == 7
+    assert not finished
+    # A client that already saw seq 8 missed nothing
+    events, missed, _ = log.wait_for_events(8, 0)
+    assert [e['seq'] for e in events] == [9, 10]
+    assert missed == 0
+
+
+def test_stream_reports_dropped_events_and_ends_after_finish(batches, client):
+    log = finished_batch(batches, 5, maxlen=2)
+    response = client.get(f"/batches/{log.batch_id}/events")
+    assert response.mimetype == 'application/x-ndjson'
+    assert ndjson(response) == [{"status": "events_dropped", "missed": 3}] + log.wait_for_events(0, 0)[0]
+
+
+def test_resume_with_after_and_last_event_id(batches, client):
+    log = finished_batch(batches, 5)
+    by_query = ndjson(client.get(f"/batches/{log.batch_id}/events?after=3"))
+    by_header = ndjson(client.get(f"/batches/{log.batch_id}/events", headers={'Last-Event-ID': '3'}))
+    assert [e['seq'] for e in by_query] == [4, 5]
+    assert by_header == by_query
+
+
+def test_non_integer_after_is_rejected(batches, client):
+    log = finished_batch(batches, 1)
+    assert client.get(f"/batches/{log.batch_id}/events?after=x").status_code == 400
+    assert client.get(f"/batches/{log.batch_id}/events", headers={'Last-Event-ID': 'x'}).status_code == 400
+    assert client.get("/batches/missing/events").status_code == 404
+
+
+def test_sse_framing(batches, client):
+    log = finished_batch(batches, 2)
+    response = client.get(f"/batches/{log.batch_id}/events", headers={'Accept': 'text/event-stream'})
+    assert response.mimetype == 'text/event-stream'
+    messages = response.get_data(as_text=True).split("\n\n")
+    assert messages[-1] == ''
+    for seq, message in enumerate(messages[:-1], start=1):
+        id_line, data_line = message.split("\n")
+        assert id_line == f"id: {seq}"
+        assert json.loads(data_line[len("data: "):])['seq'] == seq
+
+
+def test_register_batch_forgets_only_finished_batches(batches, monkeypatch):
+    monkeypatch.setattr(app, 'BATCH_HISTORY_MAX', 2)
+    running = app.register_batch(1)
+    done = app.register_batch(1)
+    done.finish()
+    newest = app.register_batch(1)
+    assert list(batches) == [running.batch_id, newest.batch_id]
+
+    # Nothing finished: keep every running batch even above the limit
+    extra = app.register_batch(1)
+    assert list(batches) == [running.batch_id, newest.batch_id, extra.batch_id]
@@ -0,0 +1,93 @@
+import io
+import json
+import threading
+import tracemalloc
+
+import pytest
+
+import app
+
+ROWS = 10_000
+# Python allocations allowed while a 10,000-row submission is received and read back.
+# The body alone is ~3 MB and the rows as a list of dicts ~8 MB.
+PEAK_ALLOCATION_CEILING = 1024 * 1024
+
+
+def ndjson_line(i):
+    row = {"palabra_clave": f"palabra clave {i}", "titulo_sugerido": f"Título sugerido número {i}",
+           "columna_extra": "x" * 200}
+    return (json.dumps(row, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+class NDJSONBody(io.RawIOBase):
+    """Request body produced line by line as the server reads it, never held in memory whole."""
+
+    def __init__(self, count):
+        self.lines = (ndjson_line(i) for i in range(count))
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self.buffer:
+            self.buffer = next(self.lines, None)
+            if self.buffer is None:
+                self.buffer = b''
+                return 0
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+
+@pytest.fixture
+def batch_runs(monkeypatch):
+    """Replace process_batch with one that only reads the stored rows back."""
+    runs = {'rows': [], 'done': threading.Event()}
+
+    def process_batch(rows, credentials_dict=None, events=None):
+        try:
+            runs['rows'].append(sum(1 for row in rows if row['palabra_clave']))
+        finally:
+            rows.close()
+            events.finish()
+            runs['done'].set()
+
+    monkeypatch.setattr(app, 'process_batch', process_batch)
+    return runs
+
+
+def post_ndjson(body, content_length):
+    client = app.app.test_client()
+    with client.session_transaction() as session:
+        session['credentials'] = {'token': 'fake'}
+    # Given as the raw WSGI input, the test client would otherwise read the body into memory
+    return client.post('/', content_type='application/x-ndjson',
+                       environ_overrides={'wsgi.input': body, 'CONTENT_LENGTH': str(content_length)})
+
+
+def test_ten_thousand_row_submission_stays_within_fixed_memory(batch_runs):
+    content_length = sum(len(ndjson_line(i)) for i in range(ROWS))
+    body = io.BufferedReader(NDJSONBody(ROWS))
+
+    tracemalloc.start()
+    try:
+        response = post_ndjson(body, content_length)
+        assert batch_runs['done'].wait(30)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert response.status_code == 200, response.get_data(as_text=True)
+    assert response.get_json()['batch_id']
+    assert batch_runs['rows'] == [ROWS]
+    assert peak < PEAK_ALLOCATION_CEILING, f"peak Python allocations {peak} bytes for {content_length} byte body"
+
+
+def test_invalid_line_is_rejected(batch_runs):
+    body = b'{"palabra_clave": "a"}\nnot json\n'
+    response = post_ndjson(io.BytesIO(body), len(body))
+    assert response.status_code == 400
+    assert "Line 2" in response.get_json()['message']
+    assert batch_runs['rows'] == []
@@ -0,0 +1,59 @@
+import pytest
+
+import app
+
+PRO = "models/gemini-3.0-pro"
+FLASH = "models/gemini-2.5-flash"
+
+
+@pytest.fixture(autouse=True)
+def cache_state(monkeypatch):
+    monkeypatch.setattr(app, 'CONTEXT_CACHE_ENABLED', True)
+    monkeypatch.setattr(app, 'CONTEXT_CACHE_UNSUPPORTED', set())
+    monkeypatch.setattr(app, 'CONTEXT_CACHE_LEARNED_MIN_TOKENS', {})
+    monkeypatch.setattr(app, 'ROUTER', app.GeminiRouter(['key']))
+
+
+def text_of_tokens(tokens):
+    return "x" * (tokens * app.CHARS_PER_TOKEN)
+
+
+def failing_upload(message):
+    def upload(model_name, contents, prompt_set, key):
+        raise Exception(message)
+    return upload
+
+
+def test_min_tokens_depend_on_model():
+    assert app.context_cache_min_tokens(FLASH) == 1024
+    assert app.context_cache_min_tokens(PRO) == 4096
+
+
+def test_short_text_is_not_uploaded(monkeypatch):
+    monkeypatch.setattr(app, 'upload_context_cache', failing_upload("must not be called"))
+    cache = app.create_context_cache([text_of_tokens(2000)], model_name=PRO)
+    assert isinstance(cache, app.LocalContextCache)
+
+
+@pytest.mark.parametrize("message", ["429 Resource has been exhausted (e.g. check quota).", "503 Service Unavailable"])
+def test_transient_error_falls_back_for_one_article(monkeypatch, message):
+    monkeypatch.setattr(app, 'upload_context_cache', failing_upload(message))
+    cache = app.create_context_cache([text_of_tokens(5000)], model_name=PRO)
+    assert isinstance(cache, app.LocalContextCache)
+    assert PRO not in app.CONTEXT_CACHE_UNSUPPORTED
+
+
+def test_too_small_error_updates_minimum(monkeypatch):
+    monkeypatch.setattr(app, 'upload_context_cache', failing_upload(
+        "400 Cached content is too small. total_token_count=1500, min_total_token_count=2048. "
+        "The minimum token count to start caching is 2048."))
+    app.create_context_cache([text_of_tokens(1500)], model_name=FLASH)
+    assert app.context_cache_min_tokens(FLASH) == 2048
+    assert FLASH not in app.CONTEXT_CACHE_UNSUPPORTED
+
+
+def test_unsupported_model_is_remembered(monkeypatch):
+    monkeypatch.setattr(app, 'upload_context_cache', failing_upload(
+        "404 models/gemini-3.0-pro is not found for API version v1beta, or is not supported for createCachedContent."))
+    app.create_context_cache([text_of_tokens(5000)], model_name=PRO)
+    assert PRO in app.CONTEXT_CACHE_UNSUPPORTED
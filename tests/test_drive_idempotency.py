@@ -0,0 +1,215 @@
+import re
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    monkeypatch.setattr(app.time, 'sleep', lambda seconds: None)
+
+
+def http_error(status):
+    return HttpError(httplib2.Response({'status': status}), b'{"error": "fake"}')
+
+
+class LostResponse:
+    """Scripted failure raised after Drive already stored the document."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class BeforeSession:
+    """Scripted failure raised before the resumable session is opened."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class FakeRequest:
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class FakeUpload:
+    """
+    A resumable upload. Raises the service's scripted failures in order; once Drive has
+    the document, resuming returns it (like the status query googleapiclient sends).
+    """
+
+    def __init__(self, files, body):
+        self.files = files
+        self.body = body
+        self.resumable_uri = None
+        self.file = None
+        self.calls = 0
+
+    def next_chunk(self, num_retries=0):
+        self.calls += 1
+        if self.file:
+            return None, self.file
+        failure = self.files.failures.pop(0) if self.files.failures else None
+        if isinstance(failure, BeforeSession):
+            raise failure.error
+        self.resumable_uri = "https://upload.example/session"
+        if isinstance(failure, Exception):
+            raise failure
+        docs = self.files.docs
+        doc = dict(self.body, id=f"doc{len(docs)}", link=f"https://docs.google.com/doc{len(docs)}")
+        docs.append(doc)
+        self.file = {'id': doc['id'], 'webViewLink': doc['link']}
+        if failure is not None:
+            raise failure.error
+        return None, self.file
+
+
+class FakeFiles:
+    """Just enough of service.files() for find_or_create_folder and save_article_to_drive."""
+
+    def __init__(self, lookup_error=None, failures=()):
+        self.docs = []
+        self.queries = []
+        self.uploads = []
+        self.lookup_error = lookup_error
+        self.failures = list(failures)
+
+    def list(self, q, **kwargs):
+        self.queries.append(q)
+        if 'appProperties' not in q:
+            return FakeRequest({'files': [{'id': 'folder', 'name': 'redactor'}]})
+        if self.lookup_error:
+            return FakeRequest(self.lookup_error)
+        value = re.search(r"value='([^']*)'", q).group(1)
+        matches = [doc for doc in self.docs if doc['appProperties'][app.IDEMPOTENCY_PROPERTY] == value]
+        return FakeRequest({'files': [{'id': doc['id'], 'webViewLink': doc['link']} for doc in matches]})
+
+    def create(self, body, media_body, fields):
+        upload = FakeUpload(self, body)
+        self.uploads.append(upload)
+        return upload
+
+
+class FakeDriveService:
+    def __init__(self, **kwargs):
+        self._files = FakeFiles(**kwargs)
+
+    def files(self):
+        return self._files
+
+
+def test_client_key_is_hashed_in_query_and_properties():
+    service = FakeDriveService()
+    key = "it's a key " + "x" * 200
+
+    first = app.save_article_to_drive("Título", "<p>a</p>", service=service, idempotency_key=key)
+    second = app.save_article_to_drive("Título", "<p>a</p>", service=service, idempotency_key=key)
+
+    assert first == second
+    assert len(service.files().docs) == 1
+    stored = service.files().docs[0]['appProperties'][app.IDEMPOTENCY_PROPERTY]
+    assert re.fullmatch(r"[0-9a-f]{64}", stored)
+    assert all(key not in q for q in service.files().queries)
+
+
+def test_failed_lookup_still_uploads():
+    service = FakeDriveService(lookup_error=OSError("connection reset"))
+    file = app.save_article_to_drive("Título", "<p>a</p>", service=service, idempotency_key="abc")
+    assert file['id'] == 'doc0'
+
+
+def test_key_changes_with_prompt_version(monkeypatch):
+    before = app.article_idempotency_key("tema", "Título")
+    prompts = app.get_prompt_set()
+    monkeypatch.setattr(prompts, 'version', 'edited')
+    assert app.article_idempotency_key("tema", "Título") != before
+
+
+def test_unknown_prompt_set_is_a_row_error(monkeypatch):
+    monkeypatch.setattr(app, 'get_drive_service', lambda creds_dict=None: FakeDriveService())
+    events = app.BatchEventLog(None, 1)
+    app.process_batch([{'palabra_clave': 'tema', 'plantilla': 'missing'}], events=events)
+    statuses = [event['status'] for event in events.wait_for_events(0, 0)[0]]
+    assert 'row_error' in statuses
+    assert statuses[-1] == 'batch_complete'
+
+
+@pytest.mark.parametrize("error", [http_error(503), http_error(429), OSError("connection reset")])
+def test_transient_error_resumes_the_same_session(error):
+    service = FakeDriveService(failures=[error])
+    file = app.save_article_to_drive("Título", "<p>a</p>", service=service)
+    files = service.files()
+    assert file['id'] == 'doc0'
+    assert len(files.uploads) == 1
+    assert files.uploads[0].calls == 2
+
+
+def test_error_before_the_session_opens_starts_a_new_one():
+    service = FakeDriveService(failures=[BeforeSession(OSError("connection refused"))])
+    app.save_article_to_drive("Título", "<p>a</p>", service=service)
+    assert len(service.files().uploads) == 2
+    assert len(service.files().docs) == 1
+
+
+@pytest.mark.parametrize("status", [404, 410])
+def test_expired_session_is_restarted(status):
+    service = FakeDriveService(failures=[http_error(status)])
+    file = app.save_article_to_drive("Título", "<p>a</p>", service=service)
+    files = service.files()
+    assert len(files.uploads) == 2
+    assert files.uploads[0].resumable_uri is not None
+    assert [doc['id'] for doc in files.docs] == [file['id']]
+
+
+def test_lost_response_is_found_by_key():
+    service = FakeDriveService(failures=[LostResponse(OSError("timeout"))])
+    file = app.save_article_to_drive("Título", "<p>a</p>", service=service, idempotency_key="abc")
+    files = service.files()
+    assert file['id'] == 'doc0'
+    assert len(files.docs) == 1
+    # Found by the lookup after the failure, without touching the upload again
+    assert files.uploads[0].calls == 1
+
+
+def test_lost_response_without_key_resumes_instead_of_duplicating():
+    service = FakeDriveService(failures=[LostResponse(OSError("timeout"))])
+    file = app.save_article_to_drive("Título", "<p>a</p>", service=service)
+    assert file['id'] == 'doc0'
+    assert len(service.files().docs) == 1
+
+
+def test_client_error_is_not_retried():
+    service = FakeDriveService(failures=[http_error(400)])
+    with pytest.raises(HttpError):
+        app.save_article_to_drive("Título", "<p>a</p>", service=service)
+    files = service.files()
+    assert len(files.uploads) == 1
+    assert files.uploads[0].calls == 1
+    assert files.docs == []
+
+
+def finished_article(topic, title, yield_json=True, prompt_set=None):
+    yield {"status": "complete", "final_article": f"<h1>{topic}</h1>", "title": topic, "prompt_version": "v1"}
+
+
+@pytest.mark.parametrize("regenerar, docs, existing", [(None, 1, True), ("TRUE", 2, None), ("sí", 2, None)])
+def test_regenerar_forces_a_new_document(monkeypatch, regenerar, docs, existing):
+    service = FakeDriveService()
+    monkeypatch.setattr(app, 'get_drive_service', lambda creds_dict=None: service)
+    monkeypatch.setattr(app, 'generate_article_logic', finished_article)
+    app.save_article_to_drive("tema", "<h1>tema</h1>", service=service,
+                              idempotency_key=app.article_idempotency_key("tema", ""))
+
+    events = app.BatchEventLog(None, 1)
+    app.process_batch([{'palabra_clave': 'tema', 'regenerar': regenerar}], events=events)
+    done = [e for e in events.wait_for_events(0, 0)[0] if e['status'] == 'row_done']
+    assert len(service.files().docs) == docs
+    assert done[0].get('existing') is existing
@@ -0,0 +1,149 @@
+import pytest
+
+import app
+
+PRO = "models/gemini-3.0-pro"
+FLASH = app.PHASE_MODELS['phase_3'][0]
+protos = app.get_genai().protos
+
+
+def reply(text):
+    return protos.GenerateContentResponse(candidates=[protos.Candidate(
+        content=protos.Content(role='model', parts=[protos.Part(text=text)]), finish_reason=1)])
+
+
+class FakeGenerativeClient:
+    def __init__(self, key, calls, fail_with=None, expired_caches=False):
+        self.key = key
+        self.calls = calls
+        self.fail_with = fail_with
+        self.expired_caches = expired_caches
+
+    def generate_content(self, request):
+        self.calls.append((self.key, request))
+        if self.fail_with:
+            raise Exception(self.fail_with)
+        if request.cached_content and self.expired_caches:
+            raise Exception("404 CachedContent not found (or permission denied)")
+        return reply(f"ok from {self.key}")
+
+    def stream_generate_content(self, request):
+        self.calls.append((self.key, request))
+        return iter([reply("<h1>Hola</h1>"), reply("<p>mundo</p>")])
+
+
+class FakeCacheClient:
+    def __init__(self, key, caches):
+        self.key = key
+        self.caches = caches
+
+    def create_cached_content(self, cached_content):
+        self.caches.append((self.key, 'create', cached_content.model))
+        return protos.CachedContent(name="cachedContents/abc", model=cached_content.model)
+
+    def delete_cached_content(self, name):
+        self.caches.append((self.key, 'delete', name))
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """Two keys, each with its own fake client; 'rate_limited' keys answer 429."""
+    state = {'calls': [], 'caches': [], 'rate_limited': set(), 'expired_caches': False}
+
+    def get_key_client(key, service='generative'):
+        if service == 'cache':
+            return FakeCacheClient(key, state['caches'])
+        fail_with = "429 Resource has been exhausted" if key in state['rate_limited'] else None
+        return FakeGenerativeClient(key, state['calls'], fail_with, state['expired_caches'])
+
+    monkeypatch.setattr(app, 'get_key_client', get_key_client)
+    monkeypatch.setattr(app, 'ROUTER', app.GeminiRouter(['key1', 'key2']))
+    monkeypatch.setattr(app, 'CONTEXT_CACHE_ENABLED', True)
+    monkeypatch.setattr(app, 'CONTEXT_CACHE_UNSUPPORTED', set())
+    return state
+
+
+def test_rate_limited_key_is_rerouted_to_its_own_client(gemini):
+    gemini['rate_limited'].add('key1')
+    text, truncated = app.generate_completion("hola", model_name=PRO)
+    assert text == "ok from key2"
+    assert not truncated
+    assert [key for key, _ in gemini['calls']] == ['key1', 'key2']
+
+
+def test_cache_is_created_and_used_on_the_routed_key(gemini):
+    # key1 is busy, so the router hands the cache to key2
+    busy_key, _ = app.ROUTER.acquire([PRO])
+    cache = app.create_context_cache(["x" * 20000], model_name=PRO)
+    assert busy_key == 'key1'
+    assert isinstance(cache, app.GeminiContextCache)
+    assert cache.api_key == 'key2'
+
+    stream = app.generate_completion("fase 4", stream=True, cached_context=cache, phase='phase_4')
+    assert ''.join(chunk.text for chunk in stream) == "<h1>Hola</h1><p>mundo</p>"
+    key, request = gemini['calls'][-1]
+    assert key == 'key2'
+    assert request.model == PRO
+    assert request.cached_content == "cachedContents/abc"
+    assert request.contents[0].parts[0].text == "fase 4"
+
+    cache.delete()
+    assert gemini['caches'] == [('key2', 'create', PRO), ('key2', 'delete', "cachedContents/abc")]
+
+
+def test_phases_3_and_4_both_reference_the_uploaded_cache(gemini):
+    cache = app.create_context_cache(["borrador " * 3000], model_name=PRO)
+    app.generate_completion("fase 3", cached_context=cache, phase='phase_3')
+    list(app.generate_completion("fase 4", stream=True, cached_context=cache, phase='phase_4'))
+
+    assert len(gemini['calls']) == 2
+    for key, request in gemini['calls']:
+        assert key == cache.api_key
+        assert request.model == PRO
+        assert request.cached_content == "cachedContents/abc"
+        assert not request.system_instruction.parts
+
+
+def test_local_context_routes_each_phase_and_resends_the_contents(gemini):
+    cache = app.create_context_cache(["borrador corto"])
+    assert isinstance(cache, app.LocalContextCache)
+    app.generate_completion("fase 3", cached_context=cache, phase='phase_3')
+    app.generate_completion("fase 4", cached_context=cache, phase='phase_4')
+
+    (_, phase_3), (_, phase_4) = gemini['calls']
+    assert phase_3.model == FLASH
+    assert phase_4.model == app.PHASE_MODELS['phase_4'][0]
+    for request in (phase_3, phase_4):
+        assert not request.cached_content
+        assert request.contents[0].parts[0].text.startswith("borrador corto\n\n")
+        assert request.system_instruction.parts[0].text == app.get_prompt_set().system_instruction
+
+
+def test_expired_cache_resends_the_contents(gemini):
+    cache = app.create_context_cache(["borrador " * 3000], model_name=PRO)
+    gemini['expired_caches'] = True
+    text, _ = app.generate_completion("fase 3", cached_context=cache, phase='phase_3')
+
+    assert text.startswith("ok from")
+    expired, resent = [request for _, request in gemini['calls']]
+    assert expired.cached_content == "cachedContents/abc"
+    assert not resent.cached_content
+    assert resent.model == FLASH
+    assert resent.contents[0].parts[0].text.endswith("\n\nfase 3")
+    # A missing cache says nothing about the model
+    assert app.ROUTER.pick_model([PRO]) == PRO
+
+    # Later phases go straight to resending, and there is nothing left to delete
+    app.generate_completion("fase 4", cached_context=cache, phase='phase_4')
+    assert not gemini['calls'][-1][1].cached_content
+    cache.delete()
+    assert gemini['caches'] == [(cache.api_key, 'create', PRO)]
+
+
+def test_only_a_named_model_is_marked_missing():
+    router = app.GeminiRouter(['key1'])
+    assert not router.report_error('key1', PRO, Exception("404 CachedContent not found (or permission denied)"))
+    assert router.pick_model([PRO, FLASH]) == PRO
+    assert router.report_error('key1', PRO, Exception(
+        f"404 {PRO} is not found for API version v1beta, or is not supported for generateContent."))
+    assert router.pick_model([PRO, FLASH]) == FLASH
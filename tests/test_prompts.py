@@ -0,0 +1,64 @@
+import os
+import shutil
+
+import pytest
+
+import app
+
+
+@pytest.fixture
+def prompts_dir(tmp_path):
+    """A copy of the shipped prompts that tests can edit."""
+    target = tmp_path / 'prompts'
+    shutil.copytree(app.PROMPTS_DIR, target)
+    return target
+
+
+def write(prompts_dir, set_name, name, text):
+    os.makedirs(prompts_dir / set_name, exist_ok=True)
+    (prompts_dir / set_name / f"{name}.txt").write_text(text, encoding='utf-8')
+
+
+def test_set_overrides_only_its_own_files(prompts_dir):
+    write(prompts_dir, 'corto', 'phase_1', "Esquema breve de {topic}")
+    sets = app.load_prompt_sets(prompts_dir)
+    default, corto = sets['default'], sets['corto']
+    assert corto.render('phase_1', topic="café", title="") == "Esquema breve de café"
+    assert corto.templates['phase_2'].text == default.templates['phase_2'].text
+    assert corto.system_instruction == default.system_instruction
+
+
+def test_version_changes_with_any_template(prompts_dir):
+    before = app.load_prompt_sets(prompts_dir)['default'].version
+    assert app.load_prompt_sets(prompts_dir)['default'].version == before
+    write(prompts_dir, 'default', 'phase_3', "Critica el artículo.")
+    assert app.load_prompt_sets(prompts_dir)['default'].version != before
+
+
+def test_render_fills_placeholders():
+    template = app.PromptTemplate('phase_1', "Tema: {topic}. Título: {title}. Llaves: {{json}}")
+    assert template.fields == {'topic', 'title'}
+    assert template.render(topic="té", title="Guía") == "Tema: té. Título: Guía. Llaves: {json}"
+
+
+def test_shipped_prompts_render_with_generation_values():
+    prompts = app.get_prompt_set('default')
+    assert "café" in prompts.render('phase_1', topic="café", title="Guía del café")
+    assert "BORRADOR" in prompts.render('article_context', truncated_draft="BORRADOR")
+
+
+def test_unknown_placeholder_fails_at_load(prompts_dir):
+    write(prompts_dir, 'erratas', 'phase_1', "Escribe sobre {tema}")
+    with pytest.raises(ValueError, match=r"erratas/phase_1.txt uses unknown placeholders \{tema\}"):
+        app.load_prompt_sets(prompts_dir)
+
+
+def test_unsupported_placeholder_syntax_fails_at_load(prompts_dir):
+    write(prompts_dir, 'erratas', 'phase_2', "Plan: {plan!r}")
+    with pytest.raises(ValueError, match="only plain"):
+        app.load_prompt_sets(prompts_dir)
+
+
+def test_missing_default_set_fails_at_load(prompts_dir):
+    with pytest.raises(ValueError, match="PROMPT_SET 'produccion' not found"):
+        app.load_prompt_sets(prompts_dir, default_set='produccion')
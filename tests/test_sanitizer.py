@@ -0,0 +1,83 @@
+import random
+import re
+
+import pytest
+
+import app
+
+ARTICLE = "<h1>Guía &amp; <em>consejos</em></h1>\n<p>Texto con `código` y más.</p>\n<h2>Otra</h2><p>Fin</p>"
+
+
+def baseline_clean(text):
+    """The cleanup done on the whole article before it was streamed."""
+    text = re.sub(r'```\s*html\s*', '', text, flags=re.IGNORECASE)
+    text = re.sub(r'```', '', text)
+    return text.strip()
+
+
+def sanitize(chunks):
+    sanitizer = app.StreamingArticleSanitizer()
+    streamed = ''.join(sanitizer.feed(chunk) for chunk in chunks) + sanitizer.close()
+    return sanitizer, streamed
+
+
+def random_chunks(text, rng):
+    cuts = sorted(rng.sample(range(1, len(text)), rng.randint(0, min(12, len(text) - 1))))
+    return [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize("raw", [
+    "```html\n" + ARTICLE + "\n```",
+    "  \n```HTML  \n" + ARTICLE + "```\n\n",
+    "```\n" + ARTICLE + "\n```html\n<p>más</p>\n```",
+    ARTICLE,
+    "\n\n" + ARTICLE + "   \n",
+])
+def test_random_chunkings_match_baseline_cleanup(raw):
+    rng = random.Random(raw)
+    for _ in range(300):
+        sanitizer, streamed = sanitize(random_chunks(raw, rng))
+        assert streamed == sanitizer.article == baseline_clean(raw)
+
+
+def test_fence_split_across_chunks():
+    _, streamed = sanitize(["<p>a</p>`", "`", "`<p>b</p>"])
+    assert streamed == "<p>a</p><p>b</p>"
+
+
+def test_fence_language_split_across_chunks():
+    sanitizer = app.StreamingArticleSanitizer()
+    assert sanitizer.feed("```ht") == ""
+    assert sanitizer.feed("ml\n<h1>T</h1>") == "<h1>T</h1>"
+    assert sanitizer.close() == ""
+    assert sanitizer.article == "<h1>T</h1>"
+
+
+def test_fence_prefix_that_is_not_html_is_kept():
+    _, streamed = sanitize(["```h", "ola"])
+    assert streamed == "hola"
+
+
+def test_leading_and_trailing_whitespace_removed():
+    sanitizer = app.StreamingArticleSanitizer()
+    assert sanitizer.feed("\n  ") == ""
+    assert sanitizer.feed("<p>a</p> ") == "<p>a</p>"
+    # Inner whitespace is only held back until more content arrives
+    assert sanitizer.feed("<p>b</p>\n") == " <p>b</p>"
+    assert sanitizer.close() == ""
+    assert sanitizer.article == "<p>a</p> <p>b</p>"
+
+
+def test_h1_with_entities_and_nested_tags():
+    sanitizer, _ = sanitize(["<h1> Guía &amp; <em>con", "sejos</em> </h1><h1>Segundo</h1>"])
+    assert sanitizer.title == "Guía & consejos"
+    assert app.extract_h1_from_html(ARTICLE) == "Guía & consejos"
+    assert app.extract_h1_from_html("<p>sin título</p>") is None
+
+
+def test_unbalanced_tags_reported():
+    sanitizer, _ = sanitize(["<h1>T</h1><div><p>a<br>", "</div></span><section>"])
+    assert sanitizer.unbalanced_tags == ["<p>", "</span>", "<section>"]
+
+    balanced, _ = sanitize([ARTICLE])
+    assert balanced.unbalanced_tags == []
@@ -0,0 +1,110 @@
+"""
+Load test for the serving profiles in serve.py.
+
+Each profile is started with a fake Gemini backend (tests/load_server.py), so every
+/generate stream stays open for ARTICLE_SECONDS. Opening SERVER_THREADS streams at once
+must finish in about one article's time; the sustained concurrency (streams served in
+parallel) is printed for every profile with `pytest -s`.
+"""
+import http.client
+import importlib.util
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from load_server import ARTICLE_SECONDS
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_THREADS = 8
+
+
+def has_modules(*names):
+    return all(importlib.util.find_spec(name) for name in names)
+
+
+PROFILES = [
+    'waitress',
+    'gthread',
+    pytest.param('gevent', marks=pytest.mark.skipif(not has_modules('gevent'), reason="gevent not installed")),
+    pytest.param('asgi', marks=pytest.mark.skipif(not has_modules('uvicorn', 'a2wsgi'),
+                                                  reason="uvicorn/a2wsgi not installed")),
+]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server(request):
+    profile = request.param
+    port = free_port()
+    env = dict(os.environ, PORT=str(port), SERVER_THREADS=str(SERVER_THREADS), WEB_CONCURRENCY='1')
+    env.pop('api_key', None)
+    proc = subprocess.Popen([sys.executable, os.path.join('tests', 'load_server.py'), profile],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    deadline = time.time() + 30
+    while True:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=5)
+            conn.request('GET', '/auth-status')
+            conn.getresponse().read()
+            break
+        except OSError:
+            if proc.poll() is not None or time.time() > deadline:
+                proc.kill()
+                pytest.fail(f"{profile} server did not start: {proc.stderr.read().decode()[-2000:]}")
+            time.sleep(0.2)
+    yield profile, port
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def generate_stream(port, results):
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    conn.request('POST', '/generate', body=json.dumps({"topic": "carga", "title": "Prueba"}),
+                 headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    lines = response.read().decode('utf-8').splitlines()
+    results.append(json.loads(lines[-1]).get('status') if lines else None)
+
+
+def open_streams(port, count):
+    """Open count /generate streams at once; return (wall time, final statuses)."""
+    results = []
+    threads = [threading.Thread(target=generate_stream, args=(port, results)) for _ in range(count)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start, results
+
+
+@pytest.mark.parametrize('server', PROFILES, indirect=True)
+def test_concurrent_generate_streams(server):
+    profile, port = server
+
+    elapsed, results = open_streams(port, SERVER_THREADS)
+    assert results == ['complete'] * SERVER_THREADS
+    # All streams run side by side: about one article's time, not SERVER_THREADS of them
+    assert elapsed < ARTICLE_SECONDS * 1.8, f"{profile}: {SERVER_THREADS} streams took {elapsed:.2f}s"
+
+    # Twice as many streams as threads shows where each profile saturates
+    count = SERVER_THREADS * 2
+    elapsed, results = open_streams(port, count)
+    assert results == ['complete'] * count
+    sustained = count * ARTICLE_SECONDS / elapsed
+    print(f"\n{profile}: {count} streams in {elapsed:.2f}s, ~{sustained:.1f} concurrent streams sustained")
@@ -0,0 +1,48 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Heavy Google SDKs that must only load on first use
+LAZY_MODULES = ('google.generativeai', 'googleapiclient', 'google_auth_oauthlib')
+# import app may take at most this share of importing google.generativeai alone
+# (about 0.2 with lazy SDKs; importing them eagerly puts it above 1)
+IMPORT_BUDGET_SHARE = 0.5
+
+
+def run_python(*args):
+    return subprocess.run([sys.executable, *args], cwd=ROOT, capture_output=True, text=True, check=True)
+
+
+def test_import_does_not_load_google_sdks():
+    result = run_python('-c', (
+        "import sys, app\n"
+        f"print('loaded:' + ','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    ))
+    loaded = [line for line in result.stdout.splitlines() if line.startswith('loaded:')]
+    assert loaded == ['loaded:']
+
+
+def import_timings(module):
+    """(cumulative microseconds, module name) for everything imported by `import module`."""
+    result = run_python('-X', 'importtime', '-c', f'import {module}')
+    # Lines look like: "import time: self [us] | cumulative | imported package"
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = [part.strip() for part in line.replace('import time:', '').split('|')]
+        timings.append((int(cumulative_us), name))
+    return timings
+
+
+def test_import_time_budget():
+    # Relative to the SDK import so the budget holds on slow and fast machines alike
+    sdk_us = next(us for us, name in import_timings('google.generativeai') if name == 'google.generativeai')
+    timings = import_timings('app')
+    app_us = next(us for us, name in timings if name == 'app')
+    slowest = sorted(timings, reverse=True)[:10]
+    assert app_us < sdk_us * IMPORT_BUDGET_SHARE, \
+        f"import app took {app_us}us (google.generativeai alone: {sdk_us}us), slowest: {slowest}"
+    assert not any(name.split('.')[0] in ('googleapiclient', 'google_auth_oauthlib') for _, name in timings)